@@ -1,8 +1,16 @@
+from abc import ABC, abstractmethod
+import atexit
+import copy
+import hashlib
+import heapq
+import itertools
 import json
 import logging
+import math
 import os
+import re
 from datetime import datetime
-from flask import Flask, request, abort
+from flask import Flask, request, abort, jsonify
 import threading
 from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
@@ -27,30 +35,1316 @@ from pathlib import Path
 from dotenv import load_dotenv
 import google.generativeai as genai
 from google.generativeai import protos
-from google.generativeai.types.file_types import File
 from PIL import Image
 import io
+import signal
+import sqlite3
+import sys
 import requests
+from requests.adapters import HTTPAdapter
 import time
-from concurrent.futures import ThreadPoolExecutor
-from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from contextlib import contextmanager
+from collections import defaultdict, deque, OrderedDict
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class MediaTooLargeError(ValueError):
+    pass
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._gauges = {}
+        self._timings = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timing = self._timings.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+            timing["count"] += 1
+            timing["total"] += seconds
+            timing["max"] = max(timing["max"], seconds)
+
+    def snapshot_counters(self, *names):
+        with self._lock:
+            return {name: self._counters.get(name, 0) for name in names}
+
+    def register_gauge(self, name, fn):
+        with self._lock:
+            self._gauges[name] = fn
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            timings = {
+                name: {"count": t["count"], "avg": round(t["total"] / t["count"], 4), "max": round(t["max"], 4)}
+                for name, t in self._timings.items()
+            }
+        snapshot = {"counters": counters, "gauges": {}, "timings": timings}
+        for name, fn in gauges.items():
+            try:
+                snapshot["gauges"][name] = fn()
+            except Exception as e:
+                logger.warning(f"讀取指標 {name} 失敗: {e}")
+        return snapshot
+
+
+class TokenEstimator:
+    CJK_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+    NON_CJK_CHARS_PER_TOKEN = 4
+    TURN_OVERHEAD_TOKENS = 4
+    IMAGE_TILE_TOKENS = 258
+    IMAGE_TILE_SIZE = 768
+    SMALL_IMAGE_MAX_EDGE = 384
+    MISSING_MEDIA_TOKENS = 16
+    AUDIO_TOKENS_PER_SECOND = 32
+    VIDEO_TOKENS_PER_SECOND = 263
+    DEFAULT_MEDIA_DURATION_SECONDS = 30
+
+    def __init__(self, image_dir, audio_dir, video_dir, metrics, image_max_edge=0, image_max_pixels=0):
+        self.image_prefix = str(image_dir)
+        self.image_max_edge = image_max_edge
+        self.image_max_pixels = image_max_pixels
+        self.audio_prefix = str(audio_dir)
+        self.media_prefixes = (str(audio_dir), str(video_dir))
+        self.scale = 1.0
+        self._lock = threading.Lock()
+        metrics.register_gauge("token_estimator.scale", lambda: round(self.scale, 3))
+
+    def estimate_text(self, text):
+        cjk_chars = len(self.CJK_PATTERN.findall(text))
+        return cjk_chars + math.ceil((len(text) - cjk_chars) / self.NON_CJK_CHARS_PER_TOKEN)
+
+    def estimate_image(self, path):
+        try:
+            with Image.open(path) as img:
+                width, height = fit_image_size(*img.size, max_edge=self.image_max_edge, max_pixels=self.image_max_pixels)
+        except (OSError, ValueError):
+            return self.MISSING_MEDIA_TOKENS
+        if width <= self.SMALL_IMAGE_MAX_EDGE and height <= self.SMALL_IMAGE_MAX_EDGE:
+            return self.IMAGE_TILE_TOKENS
+        tiles = math.ceil(width / self.IMAGE_TILE_SIZE) * math.ceil(height / self.IMAGE_TILE_SIZE)
+        return tiles * self.IMAGE_TILE_TOKENS
+
+    def estimate_live_media(self, path, media_meta):
+        if not media_meta or media_meta.get("expires_at", 0) <= time.time():
+            return self.MISSING_MEDIA_TOKENS
+        duration_ms = media_meta.get("duration_ms")
+        seconds = duration_ms / 1000 if duration_ms else self.DEFAULT_MEDIA_DURATION_SECONDS
+        per_second = self.AUDIO_TOKENS_PER_SECOND if path.startswith(self.audio_prefix) else self.VIDEO_TOKENS_PER_SECOND
+        return math.ceil(seconds * per_second)
+
+    def estimate_part(self, part, turn=None):
+        if not isinstance(part, str):
+            return self.estimate_text(str(part))
+        if part.startswith(self.image_prefix):
+            return self.estimate_image(part)
+        if part.startswith(self.media_prefixes):
+            return self.estimate_live_media(part, (turn or {}).get("media", {}).get(part))
+        return self.estimate_text(part)
+
+    def estimate_raw(self, turn):
+        return self.TURN_OVERHEAD_TOKENS + sum(self.estimate_part(part, turn) for part in turn.get('parts', []))
+
+    def estimate(self, turn):
+        return max(1, round(self.estimate_raw(turn) * self.scale))
+
+    def calibrate(self, turn, counted_tokens):
+        raw = self.estimate_raw(turn)
+        if raw <= 0 or counted_tokens <= 0:
+            return
+        with self._lock:
+            self.scale = min(4.0, max(0.25, 0.9 * self.scale + 0.1 * (counted_tokens / raw)))
+
+
+class LRUCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            return self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def chain_future(source, target):
+    def _copy_result(done):
+        if done.cancelled():
+            target.cancel()
+        elif done.exception() is not None:
+            target.set_exception(done.exception())
+        else:
+            target.set_result(done.result())
+    source.add_done_callback(_copy_result)
+
+
+class FileReadinessPoller:
+    def __init__(self, metrics, initial_interval=0.5, max_interval=10.0, timeout=180.0):
+        self.metrics = metrics
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+        metrics.register_gauge("file_poller.pending", lambda: len(self._heap))
+        self._thread = threading.Thread(target=self._run, name="file-poller", daemon=True)
+        self._thread.start()
+
+    def watch(self, uploaded_file, label):
+        future = Future()
+        future.set_running_or_notify_cancel()
+        logger.info(f"等待檔案 {uploaded_file.name} (URI: {uploaded_file.uri}, {label}) 狀態變為 ACTIVE。初始狀態: {uploaded_file.state}")
+        entry = {"file": uploaded_file, "future": future, "label": label,
+                 "interval": self.initial_interval, "started_at": time.time()}
+        if uploaded_file.state != protos.File.State.PROCESSING:
+            self._resolve(entry, uploaded_file)
+            return future
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("檔案狀態輪詢器已關閉")
+            heapq.heappush(self._heap, (time.time() + entry["interval"], next(self._seq), entry))
+            self._cond.notify()
+        return future
+
+    def _resolve(self, entry, uploaded_file):
+        name, label, future = uploaded_file.name, entry["label"], entry["future"]
+        waited = time.time() - entry["started_at"]
+        if uploaded_file.state == protos.File.State.ACTIVE:
+            logger.info(f"檔案 {name} ({label}) 已處於 ACTIVE 狀態，等待 {waited:.1f}s。")
+            self.metrics.observe("file_poller.wait_seconds", waited)
+            future.set_result(uploaded_file)
+            return
+        logger.error(f"檔案 {name} ({label}) 未處於 ACTIVE 狀態。最終狀態: {uploaded_file.state}")
+        if getattr(uploaded_file, 'error', None):
+            logger.error(f"檔案 {name} ({label}) 處理失敗: {uploaded_file.error}")
+        self.metrics.incr("file_poller.failed")
+        future.set_exception(Exception(f"File {name} ({label}) is not active (state: {uploaded_file.state}). Cannot use for generation."))
+
+    def _poll(self, entry):
+        name, label = entry["file"].name, entry["label"]
+        self.metrics.incr("file_poller.polls")
+        try:
+            uploaded_file = genai.get_file(name=name)
+        except Exception as e:
+            logger.error(f"獲取檔案 {name} ({label}) 狀態時出錯: {e}", exc_info=True)
+            entry["future"].set_exception(e)
+            return
+        if uploaded_file.state != protos.File.State.PROCESSING:
+            self._resolve(entry, uploaded_file)
+            return
+        if time.time() - entry["started_at"] > self.timeout:
+            logger.error(f"等待檔案 {name} ({label}) 變為 ACTIVE 超時 ({self.timeout}秒)。")
+            self.metrics.incr("file_poller.timeouts")
+            entry["future"].set_exception(TimeoutError(f"File {name} ({label}) did not become active in time."))
+            return
+        entry["interval"] = min(entry["interval"] * 2, self.max_interval)
+        with self._cond:
+            heapq.heappush(self._heap, (time.time() + entry["interval"], next(self._seq), entry))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and (not self._heap or self._heap[0][0] > time.time()):
+                    self._cond.wait(self._heap[0][0] - time.time() if self._heap else None)
+                if self._closed:
+                    return
+                _, _, entry = heapq.heappop(self._heap)
+            try:
+                self._poll(entry)
+            except Exception as e:
+                logger.error(f"輪詢檔案狀態時發生未預期錯誤: {e}", exc_info=True)
+                if not entry["future"].done():
+                    entry["future"].set_exception(e)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            pending, self._heap = self._heap, []
+            self._cond.notify_all()
+        self._thread.join()
+        for _, _, entry in pending:
+            entry["future"].set_exception(RuntimeError("檔案狀態輪詢器已關閉"))
+
+
+class MessageCoalescer:
+    def __init__(self, name, flush_fn, metrics, window=1.5, max_wait=5.0, max_batch=5):
+        self.name = name
+        self.flush_fn = flush_fn
+        self.metrics = metrics
+        self.window = window
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self._buffers = {}
+        self._cond = threading.Condition()
+        self._closed = False
+        metrics.register_gauge(f"coalescer.{name}.pending_keys", lambda: len(self._buffers))
+        self._thread = threading.Thread(target=self._run, name=f"coalescer-{name}", daemon=True)
+        self._thread.start()
+
+    def _due_at(self, buffer):
+        return min(buffer["last_at"] + self.window, buffer["first_at"] + self.max_wait)
+
+    def add(self, key, item, expected=None):
+        now = time.time()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError(f"訊息合併器 {self.name} 已關閉")
+            buffer = self._buffers.setdefault(key, {"items": [], "first_at": now, "last_at": now, "expected": None})
+            buffer["items"].append(item)
+            buffer["last_at"] = now
+            if expected is not None:
+                buffer["expected"] = expected
+            ready = len(buffer["items"]) >= (buffer["expected"] or self.max_batch)
+            if ready:
+                del self._buffers[key]
+            else:
+                self._cond.notify()
+        if ready:
+            self._flush(key, buffer)
+
+    def _flush(self, key, buffer):
+        items = buffer["items"]
+        self.metrics.incr(f"coalescer.{self.name}.batches")
+        self.metrics.incr(f"coalescer.{self.name}.messages", len(items))
+        self.metrics.incr(f"coalescer.{self.name}.calls_saved", len(items) - 1)
+        if buffer["expected"] is not None and len(items) < buffer["expected"]:
+            self.metrics.incr(f"coalescer.{self.name}.incomplete")
+            logger.warning(f"合併 {key} 等待逾時，僅收到 {len(items)}/{buffer['expected']} 則")
+        try:
+            self.flush_fn(key, items)
+        except Exception as e:
+            logger.error(f"送出合併的訊息 ({self.name}, {key}) 失敗: {e}", exc_info=True)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    now = time.time()
+                    due = [key for key, buffer in self._buffers.items() if self._due_at(buffer) <= now]
+                    if due:
+                        break
+                    next_due = min((self._due_at(buffer) for buffer in self._buffers.values()), default=None)
+                    self._cond.wait(next_due - now if next_due is not None else None)
+                if self._closed:
+                    return
+                ready = [(key, self._buffers.pop(key)) for key in due]
+            for key, buffer in ready:
+                self._flush(key, buffer)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            pending, self._buffers = self._buffers, {}
+            self._cond.notify_all()
+        self._thread.join()
+        for key, buffer in pending.items():
+            self._flush(key, buffer)
+
+
+class GeminiFileIndex:
+    DEFAULT_LIFETIME_SECONDS = 47 * 3600
+
+    def __init__(self, index_path, metrics, reuse_margin=3600.0):
+        self.index_path = Path(index_path)
+        self.metrics = metrics
+        self.reuse_margin = reuse_margin
+        self._lock = threading.Lock()
+        self._entries = {}
+        if self.index_path.exists():
+            try:
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    self._entries = json.load(f)
+            except (json.JSONDecodeError, OSError) as e:
+                logger.warning(f"讀取 Gemini 檔案索引失敗，將重新建立: {self.index_path} - {e}")
+        metrics.register_gauge("gemini_files.indexed", lambda: len(self._entries))
+        metrics.register_gauge("gemini_files.dedup_hit_rate", self.hit_rate)
+
+    def hit_rate(self):
+        snapshot = self.metrics.snapshot_counters("gemini_files.dedup_hits", "gemini_files.dedup_misses")
+        lookups = snapshot["gemini_files.dedup_hits"] + snapshot["gemini_files.dedup_misses"]
+        return round(snapshot["gemini_files.dedup_hits"] / lookups, 3) if lookups else 0.0
+
+    def _save(self):
+        try:
+            write_json_atomic(self.index_path, self._entries, fsync_policy="never")
+        except OSError as e:
+            logger.warning(f"寫入 Gemini 檔案索引失敗: {self.index_path} - {e}")
+
+    def lookup(self, content_hash, size_bytes=0):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(content_hash)
+            if entry is not None and entry["expires_at"] - self.reuse_margin <= now:
+                del self._entries[content_hash]
+                self._save()
+                entry = None
+        if entry is None:
+            self.metrics.incr("gemini_files.dedup_misses")
+            return None
+        self.metrics.incr("gemini_files.dedup_hits")
+        self.metrics.incr("gemini_files.dedup_bytes_saved", size_bytes)
+        return entry
+
+    def record(self, content_hash, uploaded_file):
+        expiration_time = getattr(uploaded_file, "expiration_time", None)
+        expires_at = expiration_time.timestamp() if expiration_time else time.time() + self.DEFAULT_LIFETIME_SECONDS
+        entry = {
+            "name": uploaded_file.name,
+            "uri": uploaded_file.uri,
+            "mime_type": uploaded_file.mime_type,
+            "expires_at": expires_at,
+        }
+        with self._lock:
+            self._entries = {h: e for h, e in self._entries.items() if e["expires_at"] > time.time()}
+            self._entries[content_hash] = entry
+            self._save()
+        return entry
+
+    @staticmethod
+    def as_part(entry):
+        return protos.Part(file_data=protos.FileData(file_uri=entry["uri"], mime_type=entry["mime_type"]))
+
+
+class StickerCache:
+    def __init__(self, sticker_dir, metrics):
+        self.sticker_dir = Path(sticker_dir)
+        self.sticker_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.sticker_dir / "index.json"
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self._entries = {}
+        if self.index_path.exists():
+            try:
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    self._entries = json.load(f)
+            except (json.JSONDecodeError, OSError) as e:
+                logger.warning(f"讀取貼圖快取索引失敗，將重新建立: {self.index_path} - {e}")
+        metrics.register_gauge("sticker_cache.entries", lambda: len(self._entries))
+
+    @staticmethod
+    def key(package_id, sticker_id):
+        return f"{package_id}:{sticker_id}"
+
+    def image_path(self, package_id, sticker_id):
+        return self.sticker_dir / f"{package_id}_{sticker_id}.png"
+
+    def load_image(self, package_id, sticker_id):
+        try:
+            return self.image_path(package_id, sticker_id).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def store_image(self, package_id, sticker_id, image_bytes):
+        image_path = self.image_path(package_id, sticker_id)
+        temp_path = image_path.with_name(f"{image_path.name}.tmp-{threading.get_ident()}")
+        with open(temp_path, "wb") as f:
+            f.write(image_bytes)
+        os.replace(temp_path, image_path)
+        return image_path
+
+    def get(self, package_id, sticker_id):
+        with self._lock:
+            entry = self._entries.get(self.key(package_id, sticker_id))
+        self.metrics.incr("sticker_cache.hits" if entry is not None else "sticker_cache.misses")
+        return entry
+
+    def record(self, package_id, sticker_id, description):
+        entry = {"description": description, "created_at": time.time()}
+        with self._lock:
+            self._entries[self.key(package_id, sticker_id)] = entry
+            try:
+                write_json_atomic(self.index_path, self._entries, fsync_policy="never")
+            except OSError as e:
+                logger.warning(f"寫入貼圖快取索引失敗: {self.index_path} - {e}")
+        return entry
+
+
+class DeadlineScheduler:
+    def __init__(self, name, max_workers, metrics, max_late_wait=30.0):
+        self.name = name
+        self.metrics = metrics
+        self.max_late_wait = max_late_wait
+        self._heap = []
+        self._late = deque()
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._shutdown = False
+        self._active = 0
+        metrics.register_gauge(f"scheduler.{name}.queue_depth", lambda: len(self._heap) + len(self._late))
+        metrics.register_gauge(f"scheduler.{name}.active", lambda: self._active)
+        metrics.register_gauge(f"scheduler.{name}.workers", lambda: len(self._threads))
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"{name}-worker-{i}", daemon=True)
+            for i in range(max_workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, deadline, fn, *args):
+        future = Future()
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError(f"排程器 {self.name} 已關閉，無法提交新任務")
+            heapq.heappush(self._heap, (deadline, next(self._seq), future, fn, args))
+            self._cond.notify()
+        return future
+
+    def _next_job(self):
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            self._late.append(heapq.heappop(self._heap))
+            self.metrics.incr(f"scheduler.{self.name}.deadline_misses")
+        if self._late and (not self._heap or now - self._late[0][0] > self.max_late_wait):
+            return self._late.popleft()
+        if self._heap:
+            return heapq.heappop(self._heap)
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    if self._shutdown:
+                        return
+                    self._cond.wait()
+                    job = self._next_job()
+            _, _, future, fn, args = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            with self._cond:
+                self._active += 1
+            try:
+                result = fn(*args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                if isinstance(result, Future):
+                    chain_future(result, future)
+                else:
+                    future.set_result(result)
+            finally:
+                with self._cond:
+                    self._active -= 1
+
+    def shutdown(self, wait=True):
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+class UserMailboxes:
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self._queues = {}
+        self._lock = threading.Lock()
+        metrics.register_gauge("mailboxes.active_users", lambda: len(self._queues))
+        metrics.register_gauge("mailboxes.queued_jobs", lambda: sum(len(queue) for queue in list(self._queues.values())))
+
+    def submit(self, user_id, start_fn):
+        completion = Future()
+        completion.set_running_or_notify_cancel()
+        with self._lock:
+            queue = self._queues.get(user_id)
+            if queue is None:
+                self._queues[user_id] = deque()
+            else:
+                queue.append((start_fn, completion, time.time()))
+                self.metrics.incr("mailboxes.deferred_jobs")
+                return completion
+        self._start(user_id, start_fn, completion)
+        return completion
+
+    def _start(self, user_id, start_fn, completion):
+        try:
+            job_future = start_fn()
+        except Exception as e:
+            logger.error(f"啟動使用者 {user_id} 的排隊任務失敗: {e}")
+            completion.set_exception(e)
+            self._release(user_id)
+            return
+        job_future.add_done_callback(lambda f: self._release(user_id))
+        chain_future(job_future, completion)
+
+    def _release(self, user_id):
+        with self._lock:
+            queue = self._queues[user_id]
+            if not queue:
+                del self._queues[user_id]
+                return
+            start_fn, completion, queued_at = queue.popleft()
+        self.metrics.observe("mailboxes.wait_seconds", time.time() - queued_at)
+        self._start(user_id, start_fn, completion)
+
+
+class ReplyContext:
+    def __init__(self, reply_token, received_at, ttl_seconds):
+        self.reply_token = reply_token
+        self.received_at = received_at
+        self.expires_at = received_at + ttl_seconds
+        self._used = False
+        self._lock = threading.Lock()
+
+    def is_expired(self):
+        return time.time() >= self.expires_at
+
+    def take(self):
+        with self._lock:
+            if self._used or not self.reply_token or self.is_expired():
+                return None
+            self._used = True
+            return self.reply_token
+
+
+class ConversationWindow:
+    TURN_OVERHEAD_BYTES = 256
+    RECOUNT_SEARCH_DEPTH = 8
+
+    def __init__(self, turns=(), estimator=None):
+        self.turns = deque()
+        self.total_tokens = 0
+        self.total_bytes = 0
+        self.estimator = estimator or self.estimate_turn_tokens
+        self.extend(turns)
+
+    @staticmethod
+    def estimate_turn_tokens(turn):
+        return sum(len(str(part)) for part in turn.get('parts', []))
+
+    @classmethod
+    def estimate_turn_bytes(cls, turn):
+        return cls.TURN_OVERHEAD_BYTES + sum(sys.getsizeof(part) for part in turn.get('parts', []))
+
+    def append(self, turn):
+        if 'message' in turn and 'parts' not in turn:
+            turn['parts'] = [turn.pop('message')]
+        if turn.get('tokens') is None or turn.get('token_source') is None:
+            turn['tokens'] = self.estimator(turn)
+            turn['token_source'] = "estimate"
+        self.turns.append(turn)
+        self.total_tokens += turn['tokens']
+        self.total_bytes += self.estimate_turn_bytes(turn)
+
+    def extend(self, turns):
+        for turn in turns:
+            self.append(turn)
+
+    def popleft(self):
+        turn = self.turns.popleft()
+        self.total_tokens -= turn['tokens']
+        self.total_bytes -= self.estimate_turn_bytes(turn)
+        return turn
+
+    def recount(self, turn, tokens):
+        for offset in range(1, min(len(self.turns), self.RECOUNT_SEARCH_DEPTH) + 1):
+            if self.turns[-offset] is turn:
+                self.total_tokens += tokens - turn['tokens']
+                turn['tokens'] = tokens
+                turn['token_source'] = "counted"
+                return True
+        return False
+
+    def trim_to_budget(self, max_tokens, min_turns=1):
+        removed = []
+        while self.total_tokens > max_tokens and len(self.turns) > min_turns:
+            removed.append(self.popleft())
+        return removed
+
+    def __len__(self):
+        return len(self.turns)
+
+    def __iter__(self):
+        return iter(self.turns)
+
+
+class HistoryCache:
+    def __init__(self, max_bytes, metrics):
+        self.max_bytes = max_bytes
+        self.metrics = metrics
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        metrics.register_gauge("history_cache.bytes", lambda: self._total_bytes)
+        metrics.register_gauge("history_cache.entries", lambda: len(self._entries))
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.metrics.incr("history_cache.misses")
+                return None
+            self._entries.move_to_end(user_id)
+        self.metrics.incr("history_cache.hits")
+        return entry[0]
+
+    def put(self, user_id, history):
+        size = history.total_bytes
+        with self._lock:
+            old_entry = self._entries.pop(user_id, None)
+            if old_entry is not None:
+                self._total_bytes -= old_entry[1]
+            if size > self.max_bytes:
+                return
+            self._entries[user_id] = (history, size)
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes and self._entries:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._total_bytes -= evicted_size
+                self.metrics.incr("history_cache.evictions")
+
+    def invalidate(self, user_id):
+        with self._lock:
+            entry = self._entries.pop(user_id, None)
+            if entry is not None:
+                self._total_bytes -= entry[1]
+
+
+class ImageLoader:
+    def __init__(self, max_bytes, metrics):
+        self.max_bytes = max_bytes
+        self.metrics = metrics
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._open_handles = 0
+        self._lock = threading.Lock()
+        metrics.register_gauge("image_loader.bytes", lambda: self._total_bytes)
+        metrics.register_gauge("image_loader.entries", lambda: len(self._entries))
+        metrics.register_gauge("image_loader.open_handles", lambda: self._open_handles)
+
+    @contextmanager
+    def open(self, source):
+        image = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+        with self._lock:
+            self._open_handles += 1
+        try:
+            yield image
+        finally:
+            image.close()
+            with self._lock:
+                self._open_handles -= 1
+
+    def load(self, path, build):
+        key = str(path)
+        mtime_ns = os.stat(path).st_mtime_ns
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == mtime_ns:
+                self._entries.move_to_end(key)
+                self.metrics.incr("image_loader.hits")
+                return entry[1]
+        self.metrics.incr("image_loader.misses")
+        payload = build()
+        size = len(payload[0]['data'])
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self._total_bytes -= old_entry[2]
+            if size <= self.max_bytes:
+                self._entries[key] = (mtime_ns, payload, size)
+                self._total_bytes += size
+            while self._total_bytes > self.max_bytes and self._entries:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._total_bytes -= evicted_size
+                self.metrics.incr("image_loader.evictions")
+        return payload
+
+    def invalidate(self, path):
+        with self._lock:
+            entry = self._entries.pop(str(path), None)
+            if entry is not None:
+                self._total_bytes -= entry[2]
+
+
+IMAGE_MIME_BY_SUFFIX = {".jpg": "image/jpeg", ".png": "image/png", ".webp": "image/webp"}
+IMAGE_FORMAT_BY_SUFFIX = {".jpg": "JPEG", ".png": "PNG", ".webp": "WEBP"}
+
+
+def fit_image_size(width, height, max_edge=0, max_pixels=0):
+    scale = 1.0
+    if max_edge > 0 and max(width, height) > max_edge:
+        scale = max_edge / max(width, height)
+    if max_pixels > 0 and width * height * scale * scale > max_pixels:
+        scale = math.sqrt(max_pixels / (width * height))
+    if scale >= 1.0:
+        return width, height
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def sniff_image_type(data):
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg", "jpg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png", "png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp", "webp"
+    return None
+
+
+def sha256_file(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_json_atomic(path, data, fsync_policy="data", **dump_kwargs):
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, **dump_kwargs)
+            if fsync_policy != "never":
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    if fsync_policy == "always":
+        dir_fd = os.open(path.parent, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class HistoryStore(ABC):
+    @abstractmethod
+    def load(self, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def append(self, user_id, turns, keep_last=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def clear(self, user_id):
+        raise NotImplementedError
+
+    def replace(self, user_id, turns):
+        self.clear(user_id)
+        self.append(user_id, turns)
+
+    @abstractmethod
+    def update_turn(self, user_id, message_id, fields):
+        raise NotImplementedError
+
+    def write_batch(self, batch):
+        failed = {}
+        for user_id, pending in batch.items():
+            try:
+                if pending["cleared"]:
+                    self.clear(user_id)
+                for message_id, fields in pending["updates"].items():
+                    self.update_turn(user_id, message_id, fields)
+                if pending["turns"] or pending["keep_last"] is not None:
+                    self.append(user_id, pending["turns"], keep_last=pending["keep_last"])
+            except (sqlite3.Error, OSError) as e:
+                logger.error(f"寫入使用者 {user_id} 的歷史紀錄失敗: {e}")
+                failed[user_id] = pending
+        return failed
+
+    def close(self):
+        pass
+
+
+class JsonHistoryStore(HistoryStore):
+    def __init__(self, history_dir, fsync_policy="data"):
+        self.history_dir = Path(history_dir)
+        self.fsync_policy = fsync_policy
+
+    def path_for(self, user_id):
+        return self.history_dir / f"user_{user_id}.json"
+
+    def load(self, user_id):
+        path = self.path_for(user_id)
+        if not path.exists():
+            return []
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except json.JSONDecodeError as e:
+            quarantine_path = path.with_name(f"{path.name}.corrupt-{datetime.now().strftime('%Y%m%d%H%M%S')}")
+            os.replace(path, quarantine_path)
+            logger.error(f"歷史檔案格式錯誤，已移至 {quarantine_path} 以便人工復原: {e}")
+            return []
+
+    def save(self, user_id, history):
+        write_json_atomic(self.path_for(user_id), history, fsync_policy=self.fsync_policy, indent=2)
+
+    def append(self, user_id, turns, keep_last=None):
+        history = self.load(user_id)
+        history.extend(turns)
+        if keep_last is not None:
+            history = history[-keep_last:] if keep_last > 0 else []
+        self.save(user_id, history)
+
+    def update_turn(self, user_id, message_id, fields):
+        history = self.load(user_id)
+        for turn in reversed(history):
+            if turn.get("message_id") == message_id:
+                turn.update(fields)
+                self.save(user_id, history)
+                return True
+        return False
+
+    def clear(self, user_id):
+        self.path_for(user_id).unlink(missing_ok=True)
+
+
+class SqliteDatabase:
+    def __init__(self, db_path, synchronous="NORMAL"):
+        self.db_path = str(db_path)
+        self.synchronous = synchronous
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={self.synchronous}")
+            self._local.conn = conn
+        return conn
+
+    def _run_in_transaction(self, fn):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn)
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class SqliteHistoryStore(SqliteDatabase, HistoryStore):
+    SYNCHRONOUS_BY_FSYNC_POLICY = {"always": "FULL", "data": "NORMAL", "never": "OFF"}
+
+    def __init__(self, db_path, load_limit=500, legacy_store=None, fsync_policy="data"):
+        super().__init__(db_path, self.SYNCHRONOUS_BY_FSYNC_POLICY.get(fsync_policy, "NORMAL"))
+        self.load_limit = load_limit
+        self.legacy_store = legacy_store
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS chat_turns ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " user_id TEXT NOT NULL,"
+            " turn TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_turns_user_id ON chat_turns (user_id, id)")
+
+    def _insert_turns(self, conn, user_id, turns):
+        now = time.time()
+        conn.executemany(
+            "INSERT INTO chat_turns (user_id, turn, created_at) VALUES (?, ?, ?)",
+            [(user_id, json.dumps(turn, ensure_ascii=False), now) for turn in turns],
+        )
+
+    def _trim(self, conn, user_id, keep_last):
+        if keep_last <= 0:
+            conn.execute("DELETE FROM chat_turns WHERE user_id = ?", (user_id,))
+            return
+        conn.execute(
+            "DELETE FROM chat_turns WHERE user_id = ? AND id < ("
+            " SELECT id FROM chat_turns WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+            (user_id, user_id, keep_last - 1),
+        )
+
+    def _update_turn(self, conn, user_id, message_id, fields):
+        rows = conn.execute("SELECT id, turn FROM chat_turns WHERE user_id = ? ORDER BY id DESC", (user_id,))
+        for row_id, turn_json in rows:
+            try:
+                turn = json.loads(turn_json)
+            except json.JSONDecodeError:
+                continue
+            if turn.get("message_id") == message_id:
+                turn.update(fields)
+                conn.execute("UPDATE chat_turns SET turn = ? WHERE id = ?", (json.dumps(turn, ensure_ascii=False), row_id))
+                return True
+        return False
+
+    def _migrate_legacy(self, user_id):
+        legacy_turns = self.legacy_store.load(user_id)
+        if not legacy_turns:
+            return []
+        self._run_in_transaction(lambda conn: self._insert_turns(conn, user_id, legacy_turns))
+        self.legacy_store.clear(user_id)
+        logger.info(f"已將使用者 {user_id} 的 JSON 歷史 ({len(legacy_turns)} 輪) 匯入 SQLite")
+        return legacy_turns[-self.load_limit:]
+
+    def load(self, user_id):
+        rows = self._connection().execute(
+            "SELECT turn FROM chat_turns WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+            (user_id, self.load_limit),
+        ).fetchall()
+        if not rows and self.legacy_store is not None:
+            return self._migrate_legacy(user_id)
+        history = []
+        for (turn_json,) in reversed(rows):
+            try:
+                history.append(json.loads(turn_json))
+            except json.JSONDecodeError as e:
+                logger.warning(f"略過格式錯誤的歷史紀錄 (User: {user_id}): {e}")
+        return history
+
+    def append(self, user_id, turns, keep_last=None):
+        def _append(conn):
+            self._insert_turns(conn, user_id, turns)
+            if keep_last is not None:
+                self._trim(conn, user_id, keep_last)
+        self._run_in_transaction(_append)
+
+    def update_turn(self, user_id, message_id, fields):
+        return self._run_in_transaction(lambda conn: self._update_turn(conn, user_id, message_id, fields))
+
+    def clear(self, user_id):
+        self._run_in_transaction(lambda conn: self._trim(conn, user_id, 0))
+        if self.legacy_store is not None:
+            self.legacy_store.clear(user_id)
+
+    def write_batch(self, batch):
+        def _write(conn):
+            for user_id, pending in batch.items():
+                if pending["cleared"]:
+                    self._trim(conn, user_id, 0)
+                for message_id, fields in pending["updates"].items():
+                    self._update_turn(conn, user_id, message_id, fields)
+                self._insert_turns(conn, user_id, pending["turns"])
+                if pending["keep_last"] is not None:
+                    self._trim(conn, user_id, pending["keep_last"])
+        try:
+            self._run_in_transaction(_write)
+        except sqlite3.Error as e:
+            logger.error(f"批次寫入 {len(batch)} 位使用者的歷史紀錄失敗: {e}")
+            return dict(batch)
+        if self.legacy_store is not None:
+            for user_id, pending in batch.items():
+                if pending["cleared"]:
+                    self.legacy_store.clear(user_id)
+        return {}
+
+
+class EventDedupStore(SqliteDatabase):
+    PURGE_EVERY_CLAIMS = 1000
+
+    def __init__(self, db_path, metrics, ttl_seconds=86400.0, lease_seconds=600.0, memory_entries=10000):
+        super().__init__(db_path)
+        self.metrics = metrics
+        self.ttl_seconds = ttl_seconds
+        self.lease_seconds = lease_seconds
+        self._completed = LRUCache(memory_entries)
+        self._claims = itertools.count(1)
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS webhook_events ("
+            " event_id TEXT PRIMARY KEY,"
+            " status TEXT NOT NULL,"
+            " lease_until REAL,"
+            " expires_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_webhook_events_expires_at ON webhook_events (expires_at)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS replies ("
+            " message_id TEXT PRIMARY KEY,"
+            " user_id TEXT NOT NULL,"
+            " reply_text TEXT NOT NULL,"
+            " input_tokens INTEGER NOT NULL,"
+            " output_tokens INTEGER NOT NULL,"
+            " expires_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_replies_expires_at ON replies (expires_at)")
+        metrics.register_gauge("webhook_dedup.memory_entries", lambda: len(self._completed))
+
+    def claim(self, event_id):
+        now = time.time()
+        completed_until = self._completed.get(event_id)
+        if completed_until is not None and completed_until > now:
+            self.metrics.incr("webhook_dedup.memory_hits")
+            self.metrics.incr("webhook_dedup.duplicates")
+            return False
+
+        def _claim(conn):
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO webhook_events (event_id, status, lease_until, expires_at) VALUES (?, 'inflight', ?, ?)",
+                (event_id, now + self.lease_seconds, now + self.ttl_seconds),
+            )
+            if cursor.rowcount == 1:
+                return True, None
+            status, lease_until, expires_at = conn.execute(
+                "SELECT status, lease_until, expires_at FROM webhook_events WHERE event_id = ?", (event_id,)
+            ).fetchone()
+            if expires_at > now and (status == "done" or lease_until > now):
+                return False, (expires_at if status == "done" else None)
+            conn.execute(
+                "UPDATE webhook_events SET status = 'inflight', lease_until = ?, expires_at = ? WHERE event_id = ?",
+                (now + self.lease_seconds, now + self.ttl_seconds, event_id),
+            )
+            self.metrics.incr("webhook_dedup.reclaimed")
+            return True, None
+
+        claimed, completed_until = self._run_in_transaction(_claim)
+        if completed_until is not None:
+            self._completed.put(event_id, completed_until)
+        self.metrics.incr("webhook_dedup.claimed" if claimed else "webhook_dedup.duplicates")
+        if next(self._claims) % self.PURGE_EVERY_CLAIMS == 0:
+            self.purge_expired()
+        return claimed
+
+    def complete(self, event_id):
+        expires_at = time.time() + self.ttl_seconds
+        self._run_in_transaction(lambda conn: conn.execute(
+            "UPDATE webhook_events SET status = 'done', lease_until = NULL, expires_at = ? WHERE event_id = ?",
+            (expires_at, event_id),
+        ))
+        self._completed.put(event_id, expires_at)
+
+    def release(self, event_id):
+        self._run_in_transaction(lambda conn: conn.execute("DELETE FROM webhook_events WHERE event_id = ?", (event_id,)))
+        self._completed.pop(event_id)
+
+    def record_reply(self, message_id, user_id, reply_text, input_tokens, output_tokens):
+        self._run_in_transaction(lambda conn: conn.execute(
+            "INSERT OR REPLACE INTO replies (message_id, user_id, reply_text, input_tokens, output_tokens, expires_at)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (message_id, user_id, reply_text, input_tokens, output_tokens, time.time() + self.ttl_seconds),
+        ))
+
+    def get_reply(self, message_id):
+        row = self._connection().execute(
+            "SELECT user_id, reply_text, input_tokens, output_tokens FROM replies WHERE message_id = ? AND expires_at > ?",
+            (message_id, time.time()),
+        ).fetchone()
+        if row is None:
+            return None
+        return {"user_id": row[0], "reply_text": row[1], "input_tokens": row[2], "output_tokens": row[3]}
+
+    def purge_expired(self):
+        def _purge(conn):
+            now = time.time()
+            deleted = conn.execute("DELETE FROM webhook_events WHERE expires_at < ?", (now,)).rowcount
+            return deleted + conn.execute("DELETE FROM replies WHERE expires_at < ?", (now,)).rowcount
+        deleted = self._run_in_transaction(_purge)
+        if deleted:
+            self.metrics.incr("webhook_dedup.purged", deleted)
+            logger.info(f"已清除 {deleted} 筆過期的 Webhook 去重紀錄")
+
+
+class WriteBehindHistoryStore(HistoryStore):
+    def __init__(self, backend, flush_interval, metrics):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.metrics = metrics
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        metrics.register_gauge("history_writer.pending_users", lambda: len(self._pending))
+        self._thread = None
+        if flush_interval > 0:
+            self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+            self._thread.start()
+
+    @staticmethod
+    def _apply_updates(turns, updates):
+        unmatched = {}
+        for message_id, fields in updates.items():
+            for index in range(len(turns) - 1, -1, -1):
+                if turns[index].get("message_id") == message_id:
+                    turns[index] = {**turns[index], **fields}
+                    break
+            else:
+                unmatched[message_id] = fields
+        return unmatched
+
+    @staticmethod
+    def _merge(older, newer):
+        if older is None or newer["cleared"]:
+            return newer
+        turns = list(older["turns"])
+        updates = dict(older["updates"])
+        for message_id, fields in WriteBehindHistoryStore._apply_updates(turns, newer["updates"]).items():
+            updates[message_id] = {**updates.get(message_id, {}), **fields}
+        turns += newer["turns"]
+        keep_last = newer["keep_last"]
+        if keep_last is None and older["keep_last"] is not None:
+            keep_last = older["keep_last"] + len(newer["turns"])
+        if keep_last is not None and len(turns) > keep_last:
+            turns = turns[len(turns) - keep_last:]
+        return {"cleared": older["cleared"], "turns": turns, "keep_last": keep_last, "updates": updates}
+
+    def _enqueue(self, user_id, pending):
+        with self._lock:
+            self._pending[user_id] = self._merge(self._pending.get(user_id), pending)
+        if self._thread is None:
+            self.flush()
+
+    def load(self, user_id):
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending.get(user_id)
+            if pending is None:
+                return self.backend.load(user_id)
+            pending = copy.deepcopy(pending)
+            history = [] if pending["cleared"] else self.backend.load(user_id)
+            self._apply_updates(history, pending["updates"])
+            history.extend(pending["turns"])
+            if pending["keep_last"] is not None:
+                history = history[-pending["keep_last"]:]
+            return history
+
+    def append(self, user_id, turns, keep_last=None):
+        if keep_last is not None and keep_last <= 0:
+            self.clear(user_id)
+            return
+        self._enqueue(user_id, {"cleared": False, "turns": copy.deepcopy(list(turns)), "keep_last": keep_last, "updates": {}})
+
+    def clear(self, user_id):
+        self._enqueue(user_id, {"cleared": True, "turns": [], "keep_last": None, "updates": {}})
+
+    def replace(self, user_id, turns):
+        self._enqueue(user_id, {"cleared": True, "turns": copy.deepcopy(list(turns)), "keep_last": None, "updates": {}})
+
+    def update_turn(self, user_id, message_id, fields):
+        self._enqueue(user_id, {"cleared": False, "turns": [], "keep_last": None, "updates": {message_id: copy.deepcopy(dict(fields))}})
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return
+            try:
+                failed = self.backend.write_batch(batch)
+            except Exception as e:
+                logger.error(f"批次寫入歷史紀錄時發生未預期的錯誤，保留 {len(batch)} 位使用者的資料待重試: {e}", exc_info=True)
+                failed = dict(batch)
+            self.metrics.incr("history_writer.batches")
+            self.metrics.incr("history_writer.users_written", len(batch) - len(failed))
+            if failed:
+                self.metrics.incr("history_writer.failed_users", len(failed))
+                with self._lock:
+                    for user_id, pending in failed.items():
+                        newer = self._pending.get(user_id)
+                        self._pending[user_id] = pending if newer is None else self._merge(pending, newer)
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"背景寫入歷史紀錄時發生錯誤: {e}", exc_info=True)
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        with self._lock:
+            unwritten = len(self._pending)
+        if unwritten:
+            logger.error(f"關閉時仍有 {unwritten} 位使用者的歷史紀錄未能寫入")
+        self.backend.close()
+
+
 class ChatBot:
     def __init__(self):
         self.app = Flask(__name__)
         self.load_environment()
         self.setup_line_bot()
         self.setup_gemini_config()
-        self.currently_processing_message_ids = set()
-        self.processing_lock = threading.Lock()
+        self.metrics = Metrics()
+        self.setup_history_store()
+        self.image_loader = ImageLoader(self.image_cache_max_bytes, self.metrics)
+        self.event_dedup = EventDedupStore(
+            self.webhook_dedup_db_path,
+            self.metrics,
+            ttl_seconds=self.webhook_dedup_ttl,
+            lease_seconds=self.webhook_dedup_lease,
+            memory_entries=self.webhook_dedup_memory_entries,
+        )
         self.user_history_locks = defaultdict(threading.Lock)
+        self.mailboxes = UserMailboxes(self.metrics)
         self.max_worker_threads = int(os.getenv("MAX_WORKER_THREADS", 5))
-        self.thread_pool = ThreadPoolExecutor(max_workers=self.max_worker_threads)
-        logger.info(f"ThreadPoolExecutor initialized with max_workers={self.max_worker_threads}")
+        lane_workers = {
+            "text": int(os.getenv("TEXT_WORKER_THREADS", self.max_worker_threads)),
+            "image": int(os.getenv("IMAGE_WORKER_THREADS", 3)),
+            "media": int(os.getenv("MEDIA_WORKER_THREADS", 2)),
+        }
+        self.lanes = {
+            lane: DeadlineScheduler(lane, workers, self.metrics, max_late_wait=self.scheduler_max_late_wait)
+            for lane, workers in lane_workers.items()
+        }
+        logger.info(f"工作通道已初始化: {lane_workers}")
+        self.sticker_cache = StickerCache(self.sticker_cache_dir, self.metrics)
+        self.http_session = requests.Session()
+        self.http_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=self.sticker_fetch_workers))
+        self.sticker_fetch_pool = ThreadPoolExecutor(max_workers=self.sticker_fetch_workers, thread_name_prefix="sticker-fetch")
+        self.gemini_file_index = GeminiFileIndex(self.cache_dir / "gemini_files.json", self.metrics, reuse_margin=self.gemini_file_reuse_margin)
+        self.file_poller = FileReadinessPoller(
+            self.metrics,
+            initial_interval=self.file_processing_initial_poll_interval,
+            max_interval=self.file_processing_poll_interval,
+            timeout=self.file_processing_timeout,
+        )
+        self._history_reuploads = {}
+        self._history_reuploads_lock = threading.Lock()
+        self.media_distill_pool = None
+        if self.media_distillation:
+            self.media_distill_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="media-distiller")
+            logger.info(f"媒體摘要已啟用，保留最近 {self.media_distill_keep_recent} 則媒體原始內容")
+        self.content_download_pool = ThreadPoolExecutor(max_workers=self.content_download_workers, thread_name_prefix="content-download")
+        self.message_coalescer = None
+        self.image_set_assembler = None
         self.setup_routes()
+        self._shutdown_done = False
+        atexit.register(self.shutdown)
+
+    COALESCIBLE_EVENT_TYPES = frozenset({"text", "image"})
 
     def load_environment(self):
         load_dotenv()
@@ -60,20 +1354,69 @@ class ChatBot:
         self.model_name = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
         self.history_dir = Path("history")
         self.history_dir.mkdir(exist_ok=True)
+        self.history_backend = os.getenv("HISTORY_BACKEND", "json").lower()
+        self.history_db_path = os.getenv("HISTORY_DB_PATH", str(self.history_dir / "history.db"))
+        self.history_load_limit = int(os.getenv("HISTORY_LOAD_LIMIT_TURNS", 500))
+        self.history_cache_max_bytes = int(os.getenv("HISTORY_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+        self.history_flush_interval = float(os.getenv("HISTORY_FLUSH_INTERVAL_SECONDS", "1.0"))
+        self.history_fsync_policy = os.getenv("HISTORY_FSYNC_POLICY", "data").lower()
+        self.token_budget_mode = os.getenv("TOKEN_BUDGET_MODE", "heuristic").lower()
         self.image_dir = Path("images")
         self.image_dir.mkdir(exist_ok=True)
+        self.image_max_edge = int(os.getenv("IMAGE_MAX_EDGE", 1536))
+        self.image_max_pixels = int(os.getenv("IMAGE_MAX_PIXELS", 0))
+        self.image_cache_max_bytes = int(os.getenv("IMAGE_CACHE_MAX_BYTES", 32 * 1024 * 1024))
         self.audio_dir = Path("audios")
         self.audio_dir.mkdir(exist_ok=True)
         self.video_dir = Path("videos")
         self.video_dir.mkdir(exist_ok=True)
+        self.cache_dir = Path("cache")
+        self.cache_dir.mkdir(exist_ok=True)
+        self.sticker_cache_dir = Path(os.getenv("STICKER_CACHE_DIR", "stickers"))
+        self.webhook_dedup_db_path = os.getenv("WEBHOOK_DEDUP_DB_PATH", str(self.cache_dir / "webhook_events.db"))
+        self.webhook_dedup_ttl = float(os.getenv("WEBHOOK_DEDUP_TTL_SECONDS", 86400))
+        self.webhook_dedup_lease = float(os.getenv("WEBHOOK_DEDUP_LEASE_SECONDS", 600))
+        self.webhook_dedup_memory_entries = int(os.getenv("WEBHOOK_DEDUP_MEMORY_ENTRIES", 10000))
+        self.sticker_fetch_timeout = float(os.getenv("STICKER_FETCH_TIMEOUT_SECONDS", 10))
+        self.sticker_fetch_workers = int(os.getenv("STICKER_FETCH_WORKERS", 6))
+        self.gemini_file_reuse_margin = float(os.getenv("GEMINI_FILE_REUSE_MARGIN_SECONDS", 3600))
+        self.history_media_expiry_margin = float(os.getenv("HISTORY_MEDIA_EXPIRY_MARGIN_SECONDS", 300))
+        self.history_media_reupload = os.getenv("HISTORY_MEDIA_REUPLOAD", "false").lower() == "true"
+        self.media_distillation = os.getenv("MEDIA_DISTILLATION", "false").lower() == "true"
+        self.media_distill_keep_recent = int(os.getenv("MEDIA_DISTILL_KEEP_RECENT", 2))
+        self.media_description_max_chars = int(os.getenv("MEDIA_DESCRIPTION_MAX_CHARS", 200))
         self.system_prompt_file = os.getenv("SYSTEM_PROMPT_FILE", "system_prompt.txt")
         self.max_history_tokens = int(os.getenv("MAX_HISTORY_TOKENS", 8000))
         self.temperature = float(os.getenv("TEMPERATURE", "0.7"))
+        self.gemini_streaming = os.getenv("GEMINI_STREAMING", "false").lower() == "true"
+        self.stream_first_bubble_min_chars = int(os.getenv("STREAM_FIRST_BUBBLE_MIN_CHARS", 20))
+        self.reply_token_ttl = float(os.getenv("REPLY_TOKEN_TTL_SECONDS", 50))
+        self.coalesce_window = float(os.getenv("COALESCE_WINDOW_SECONDS", 0))
+        self.coalesce_max_wait = float(os.getenv("COALESCE_MAX_WAIT_SECONDS", 5))
+        self.coalesce_max_batch = int(os.getenv("COALESCE_MAX_BATCH", 5))
+        self.image_set_timeout = float(os.getenv("IMAGE_SET_TIMEOUT_SECONDS", 10))
+        self.image_set_max_images = int(os.getenv("IMAGE_SET_MAX_IMAGES", 20))
+        self.content_download_workers = int(os.getenv("CONTENT_DOWNLOAD_WORKERS", 4))
+        requested_coalesce_types = {t.strip() for t in os.getenv("COALESCE_EVENT_TYPES", "text,image").split(",") if t.strip()}
+        self.coalesce_event_types = requested_coalesce_types & self.COALESCIBLE_EVENT_TYPES
+        if requested_coalesce_types - self.coalesce_event_types:
+            logger.warning(f"COALESCE_EVENT_TYPES 僅支援 {sorted(self.COALESCIBLE_EVENT_TYPES)}，"
+                           f"已忽略: {sorted(requested_coalesce_types - self.coalesce_event_types)}")
+        self.event_processing_budget = {"text": 5.0, "image": 15.0, "sticker": 10.0, "audio": 30.0, "video": 60.0, "resume": 5.0}
+        for item in os.getenv("EVENT_PROCESSING_BUDGET_SECONDS", "").split(","):
+            if "=" in item:
+                event_type, seconds = item.split("=", 1)
+                self.event_processing_budget[event_type.strip()] = float(seconds)
+        self.scheduler_max_late_wait = float(os.getenv("SCHEDULER_MAX_LATE_WAIT_SECONDS", 30))
         self.prompts_dir = Path("prompts")
         self.prompts_dir.mkdir(exist_ok=True)
+        self.media_max_bytes = int(os.getenv("MEDIA_MAX_BYTES", 200 * 1024 * 1024))
+        self.media_download_chunk_bytes = int(os.getenv("MEDIA_DOWNLOAD_CHUNK_BYTES", 1024 * 1024))
+        self.media_download_timeout = float(os.getenv("MEDIA_DOWNLOAD_TIMEOUT_SECONDS", 30))
         self.file_processing_timeout = int(os.getenv("FILE_PROCESSING_TIMEOUT_SECONDS", 180))
-        self.file_processing_poll_interval = int(os.getenv("FILE_PROCESSING_POLL_INTERVAL_SECONDS", 10))
-        logger.info(f"File processing timeout: {self.file_processing_timeout}s, poll interval: {self.file_processing_poll_interval}s")
+        self.file_processing_poll_interval = float(os.getenv("FILE_PROCESSING_POLL_INTERVAL_SECONDS", 10))
+        self.file_processing_initial_poll_interval = float(os.getenv("FILE_PROCESSING_INITIAL_POLL_SECONDS", 0.5))
+        logger.info(f"File processing timeout: {self.file_processing_timeout}s, poll interval: {self.file_processing_initial_poll_interval}s -> {self.file_processing_poll_interval}s")
 
     def setup_line_bot(self):
         self.configuration = Configuration(access_token=self.line_access_token)
@@ -89,72 +1432,273 @@ class ChatBot:
             "top_k": 64,
             "max_output_tokens": int(os.getenv("GEMINI_MAX_OUTPUT_TOKENS", "8192")),
         }
+        self.model_cache = LRUCache(int(os.getenv("MODEL_CACHE_SIZE", 32)))
+        self.prompt_cache = LRUCache(int(os.getenv("PROMPT_CACHE_SIZE", 1024)))
+
+    def get_generative_model(self, system_prompt=None):
+        prompt_hash = hashlib.sha256(system_prompt.encode("utf-8")).hexdigest() if system_prompt else ""
+        cache_key = (self.model_name, prompt_hash, tuple(sorted(self.generation_config_dict.items())))
+        model = self.model_cache.get(cache_key)
+        if model is not None:
+            self.metrics.incr("model_cache.hits")
+            return model
+        self.metrics.incr("model_cache.misses")
+        model = genai.GenerativeModel(
+            model_name=self.model_name,
+            generation_config=self.generation_config_dict,
+            system_instruction=system_prompt,
+        )
+        self.model_cache.put(cache_key, model)
+        return model
+
+    def _read_prompt_file(self, path):
+        cache_key = str(path)
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            self.prompt_cache.pop(cache_key)
+            return None
+        cached = self.prompt_cache.get(cache_key)
+        if cached is not None and cached[0] == mtime_ns:
+            return cached[1]
+        text = Path(path).read_text(encoding="utf-8").strip()
+        self.prompt_cache.put(cache_key, (mtime_ns, text))
+        return text
 
     def get_system_prompt(self, user_id):
-        user_prompt_file = self.prompts_dir / f"user_{user_id}.txt"
-        if user_prompt_file.exists():
-            return user_prompt_file.read_text(encoding="utf-8").strip()
-        default_prompt_path = Path(self.system_prompt_file)
-        if default_prompt_path.exists():
-            return default_prompt_path.read_text(encoding="utf-8").strip()
+        user_prompt = self._read_prompt_file(self.prompts_dir / f"user_{user_id}.txt")
+        if user_prompt is not None:
+            return user_prompt
+        default_prompt = self._read_prompt_file(self.system_prompt_file)
+        if default_prompt is not None:
+            return default_prompt
         return "你是一個友善、溫暖且樂於助人的AI助手。請使用繁體中文與使用者互動，保持簡潔、親切、同理心的語調。如果收到圖片、貼圖、語音或影片，請描述它們或理解其內容，並根據上下文回應。"
 
+    def setup_history_store(self):
+        if self.history_fsync_policy not in ("always", "data", "never"):
+            logger.warning(f"未知的 HISTORY_FSYNC_POLICY: {self.history_fsync_policy}，改用 data")
+            self.history_fsync_policy = "data"
+        json_store = JsonHistoryStore(self.history_dir, fsync_policy=self.history_fsync_policy)
+        if self.history_backend == "sqlite":
+            backend = SqliteHistoryStore(self.history_db_path, load_limit=self.history_load_limit, legacy_store=json_store, fsync_policy=self.history_fsync_policy)
+        else:
+            if self.history_backend != "json":
+                logger.warning(f"未知的 HISTORY_BACKEND: {self.history_backend}，改用 json")
+            backend = json_store
+        self.history_store = WriteBehindHistoryStore(backend, self.history_flush_interval, self.metrics)
+        logger.info(f"歷史紀錄儲存後端: {type(backend).__name__}，寫入間隔: {self.history_flush_interval}s，fsync: {self.history_fsync_policy}")
+        self.history_cache = HistoryCache(self.history_cache_max_bytes, self.metrics)
+        logger.info(f"歷史紀錄快取上限: {self.history_cache_max_bytes} bytes")
+        self.token_estimator = TokenEstimator(self.image_dir, self.audio_dir, self.video_dir, self.metrics,
+                                              image_max_edge=self.image_max_edge, image_max_pixels=self.image_max_pixels)
+        self.token_count_pool = None
+        if self.token_budget_mode == "calibrated":
+            self.token_count_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="token-counter")
+        logger.info(f"歷史 Token 預算模式: {self.token_budget_mode}")
+
     def load_chat_history(self, user_id):
-        path = self.history_dir / f"user_{user_id}.json"
-        if path.exists():
+        history = self.history_cache.get(user_id)
+        if history is None:
+            history = ConversationWindow(self.history_store.load(user_id), estimator=self.token_estimator.estimate)
+            self.history_cache.put(user_id, history)
+        return history
+
+    def commit_chat_history(self, user_id, history, new_turns):
+        try:
+            self.history_store.append(user_id, new_turns, keep_last=len(history))
+        except (sqlite3.Error, IOError) as e:
+            logger.error(f"儲存歷史紀錄失敗 (User: {user_id}): {e}", exc_info=True)
+            self.history_cache.invalidate(user_id)
+            return
+        self.history_cache.put(user_id, history)
+
+    def clear_chat_history(self, user_id):
+        self.history_cache.invalidate(user_id)
+        self.history_store.clear(user_id)
+
+    def calibrate_turn_tokens(self, user_id, history, turns):
+        model = self.get_generative_model()
+        counted = []
+        for turn in turns:
+            contents = self._prepare_gemini_history([turn])
+            if not contents:
+                continue
             try:
-                with open(path, "r", encoding="utf-8") as f:
-                    return json.load(f)
-            except (json.JSONDecodeError, IOError) as e:
-                logger.warning(f"讀取歷史檔案失敗或格式錯誤: {path} - {e}")
-                return []
-        return []
-
-    def save_chat_history(self, user_id, history):
-        path = self.history_dir / f"user_{user_id}.json"
+                counted.append((turn, model.count_tokens(contents).total_tokens))
+            except Exception as e:
+                logger.warning(f"計算歷史 Token 失敗 (User: {user_id}): {e}")
+                self.metrics.incr("token_calibration.errors")
+        with self.user_history_locks[user_id]:
+            for turn, tokens in counted:
+                self.token_estimator.calibrate(turn, tokens)
+                if history.recount(turn, tokens):
+                    self.metrics.incr("token_calibration.turns_counted")
+
+    def media_part_paths(self, turn):
+        media_prefixes = (str(self.image_dir), str(self.audio_dir), str(self.video_dir))
+        return [part for part in turn.get('parts', []) if isinstance(part, str) and part.startswith(media_prefixes)]
+
+    def describe_media(self, media_part, media_kind):
+        instruction = (f"請用繁體中文、不超過 {self.media_description_max_chars} 字，客觀描述這個{media_kind}的內容，"
+                       "包含畫面中的文字、語音說了什麼以及可辨識的情緒，供之後的對話參考。只輸出描述本身。")
+        started_at = time.time()
+        response = self.get_generative_model().generate_content([instruction, media_part])
+        self.metrics.observe("media_distill.seconds", time.time() - started_at)
+        return response.text.strip()
+
+    STICKER_URL_VARIANTS = ("ANDROID", "IOS", "STATIC")
+
+    def _fetch_sticker_variant(self, sticker_id, variant):
+        s_url = f"https://stickershop.line-scdn.net/stickershop/v1/sticker/{sticker_id}/{variant}/sticker.png"
+        response = self.http_session.get(s_url, timeout=self.sticker_fetch_timeout)
+        response.raise_for_status()
+        if not response.content:
+            raise ValueError(f"空的貼圖內容: {s_url}")
+        return variant, response.content
+
+    def fetch_sticker_image(self, package_id, sticker_id):
+        started_at = time.time()
+        futures = [self.sticker_fetch_pool.submit(self._fetch_sticker_variant, sticker_id, variant) for variant in self.STICKER_URL_VARIANTS]
         try:
-            with open(path, "w", encoding="utf-8") as f:
-                json.dump(history, f, ensure_ascii=False, indent=2)
-        except IOError as e:
-            logger.error(f"儲存歷史檔案失敗: {path} - {e}")
+            for future in as_completed(futures, timeout=self.sticker_fetch_timeout):
+                try:
+                    variant, sticker_image_bytes = future.result()
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    logger.warning(f"下載貼圖圖片時發生錯誤 ({package_id}/{sticker_id}): {e}")
+                    continue
+                self.metrics.observe("sticker_fetch.seconds", time.time() - started_at)
+                self.metrics.incr(f"sticker_fetch.wins.{variant.lower()}")
+                logger.info(f"成功下載貼圖 {package_id}/{sticker_id} 的 {variant} 圖片 ({len(sticker_image_bytes)} bytes)")
+                return sticker_image_bytes
+        except FuturesTimeoutError:
+            logger.warning(f"下載貼圖 {package_id}/{sticker_id} 超時 ({self.sticker_fetch_timeout}s)")
+        finally:
+            for future in futures:
+                future.cancel()
+        self.metrics.incr("sticker_fetch.failures")
+        return None
+
+    def cache_sticker(self, package_id, sticker_id, sticker_image_bytes):
+        sticker_path = self.sticker_cache.store_image(package_id, sticker_id, sticker_image_bytes)
+        try:
+            description = self.describe_media(self.model_image_part(sticker_path, sticker_image_bytes), "LINE 貼圖")
+        except Exception as e:
+            logger.warning(f"產生貼圖描述失敗 {package_id}/{sticker_id}: {e}")
+            self.metrics.incr("sticker_cache.describe_errors")
+            return None
+        logger.info(f"已快取貼圖 {package_id}/{sticker_id} 的描述")
+        return self.sticker_cache.record(package_id, sticker_id, description)
+
+    def distill_turn_media(self, user_id, turn):
+        descriptions = {}
+        for media_path in self.media_part_paths(turn):
+            if media_path in turn.get("descriptions", {}):
+                continue
+            media_part = self._history_part(turn, media_path)
+            if isinstance(media_part, str):
+                continue
+            media_kind = "圖片" if media_path.startswith(str(self.image_dir)) else "音訊" if media_path.startswith(str(self.audio_dir)) else "影片"
+            try:
+                descriptions[media_path] = self.describe_media(media_part, media_kind)
+                self.metrics.incr("media_distill.described")
+            except Exception as e:
+                logger.warning(f"產生媒體摘要失敗 {media_path} (User: {user_id}): {e}")
+                self.metrics.incr("media_distill.errors")
+        if not descriptions:
+            return
+        with self.user_history_locks[user_id]:
+            history = self.load_chat_history(user_id)
+            updated_turns = []
+            for stored_turn in history:
+                matched = {path: text for path, text in descriptions.items() if path in stored_turn.get('parts', [])}
+                if matched:
+                    stored_turn.setdefault("descriptions", {}).update(matched)
+                    updated_turns.append(stored_turn)
+            if not updated_turns:
+                return
+            if all(stored_turn.get("message_id") for stored_turn in updated_turns):
+                for stored_turn in updated_turns:
+                    self.history_store.update_turn(user_id, stored_turn["message_id"], {"descriptions": stored_turn["descriptions"]})
+            else:
+                self.history_store.replace(user_id, list(history))
+            logger.info(f"已為使用者 {user_id} 的 {len(updated_turns)} 則歷史輪次儲存媒體文字摘要")
+
+    def _distilled_turn_ids(self, local_history):
+        if not self.media_distillation:
+            return set()
+        distilled = set()
+        recent_media_turns = 0
+        for turn in reversed(list(local_history)):
+            if not self.media_part_paths(turn):
+                continue
+            recent_media_turns += 1
+            if recent_media_turns > self.media_distill_keep_recent:
+                distilled.add(id(turn))
+        return distilled
+
+    def delete_media_file(self, part_data):
+        if not part_data.startswith((str(self.image_dir), str(self.audio_dir), str(self.video_dir))):
+            return False
+        part_path = Path(part_data)
+        part_path.unlink(missing_ok=True)
+        if part_data.startswith(str(self.image_dir)):
+            self.model_image_path(part_path).unlink(missing_ok=True)
+            self.image_loader.invalidate(part_path)
+        return True
 
     def manage_chat_history(self, history):
-        total_tokens = sum(len(str(part)) for turn in history for part in turn.get('parts', []))
-        while total_tokens > self.max_history_tokens and len(history) > 1:
-            removed_turn = history.pop(0)
-            removed_tokens_this_turn = 0
+        removed_turns = history.trim_to_budget(self.max_history_tokens, min_turns=2)
+        if not removed_turns:
+            return history
+        still_referenced = {part for turn in history for part in self.media_part_paths(turn)}
+        for removed_turn in removed_turns:
             for part_data in removed_turn.get('parts', []):
-                removed_tokens_this_turn += len(str(part_data))
-                if isinstance(part_data, str):
-                    part_path = Path(part_data)
-                    if (part_data.startswith(str(self.image_dir)) or
-                        part_data.startswith(str(self.audio_dir)) or
-                        part_data.startswith(str(self.video_dir))):
-                        try:
-                            part_path.unlink(missing_ok=True)
+                if isinstance(part_data, str) and part_data in still_referenced:
+                    logger.info(f"媒體檔案仍被其他歷史輪次引用，保留: {part_data}")
+                elif isinstance(part_data, str):
+                    try:
+                        if self.delete_media_file(part_data):
                             logger.info(f"已從歷史記錄管理器中刪除媒體檔案: {part_data}")
-                        except OSError as e:
-                            logger.warning(f"刪除歷史媒體檔案失敗 {part_data}: {e}")
-            total_tokens -= removed_tokens_this_turn
-            if total_tokens <= 0 and len(history) > 1 :
-                logger.warning("Token 計算可能異常，已重置為0並保留至少一輪歷史。")
-                total_tokens = sum(len(str(part)) for turn in history for part in turn.get('parts', []))
+                    except OSError as e:
+                        logger.warning(f"刪除歷史媒體檔案失敗 {part_data}: {e}")
         return history
 
-    def get_ai_response(self, user_id, history_for_gemini_processing, user_content):
+    SENTENCE_BOUNDARY_PATTERN = re.compile(r"[。！？!?…\n]|\.(?=\s)")
+    LINE_MAX_TEXT_LENGTH = 5000
+    LINE_MAX_MESSAGES_PER_REQUEST = 5
+
+    def _stream_ai_response(self, user_id, chat_session, user_content, on_first_bubble):
+        buffer = ""
+        first_bubble_sent = False
         try:
-            system_prompt = self.get_system_prompt(user_id)
-            model = genai.GenerativeModel(
-                model_name=self.model_name,
-                generation_config=self.generation_config_dict,
-                system_instruction=system_prompt,
-            )
+            for chunk in chat_session.send_message(user_content, stream=True):
+                buffer += chunk.text
+                if first_bubble_sent:
+                    continue
+                boundary_end = None
+                for match in self.SENTENCE_BOUNDARY_PATTERN.finditer(buffer, max(0, self.stream_first_bubble_min_chars - 1)):
+                    boundary_end = match.end()
+                if boundary_end is not None and buffer[:boundary_end].strip():
+                    on_first_bubble(buffer[:boundary_end].strip())
+                    first_bubble_sent = True
+        except Exception as e:
+            if not first_bubble_sent:
+                raise
+            logger.error(f"Gemini 串流回應中斷，以已收到的內容作為回覆 (User: {user_id})：{e}", exc_info=True)
+        return buffer.strip()
+
+    def get_ai_response(self, user_id, history_for_gemini_processing, user_content, on_first_bubble=None):
+        try:
+            model = self.get_generative_model(self.get_system_prompt(user_id))
             if not user_content:
                 logger.error("get_ai_response收到的user_content為空")
                 return "抱歉，無法處理空的請求。"
             if logger.isEnabledFor(logging.DEBUG):
                  logger.debug(f"向 Gemini 發送歷史 (User: {user_id}): {len(history_for_gemini_processing)} turns. 用戶內容類型: {[type(p) for p in user_content]}")
             chat_session = model.start_chat(history=history_for_gemini_processing)
+            if self.gemini_streaming and on_first_bubble is not None:
+                reply_text = self._stream_ai_response(user_id, chat_session, user_content, on_first_bubble)
+                return reply_text or "抱歉，我暫時無法回應。"
             response = chat_session.send_message(user_content)
             return response.text.strip() if response.text else "抱歉，我暫時無法回應。"
         except Exception as e:
@@ -175,49 +1719,296 @@ class ChatBot:
                 return "抱歉，您上傳的檔案類型可能不受支援，或檔案處理時發生問題。"
             return "發生錯誤，請稍後再試～"
 
+    def _split_text_messages(self, text):
+        return [text[i:i + self.LINE_MAX_TEXT_LENGTH] for i in range(0, len(text), self.LINE_MAX_TEXT_LENGTH)]
+
+    EVENT_LANES = {"text": "text", "image": "image", "sticker": "image", "audio": "media", "video": "media"}
+
+    def lane_for(self, event_type):
+        return self.lanes[self.EVENT_LANES.get(event_type, "text")]
+
+    def job_deadline(self, event_type, reply_context=None):
+        budget = self.event_processing_budget.get(event_type, self.reply_token_ttl)
+        now = time.time()
+        if reply_context is not None and reply_context.reply_token and reply_context.expires_at - budget > now:
+            return reply_context.expires_at - budget
+        return now + budget
+
+    def resume_in_lane(self, waiting_future, event_type, fn, *args):
+        completion = Future()
+        completion.set_running_or_notify_cancel()
+
+        def _resume(ready_future):
+            try:
+                lane_future = self.lane_for(event_type).submit(time.time() + self.event_processing_budget["resume"], fn, ready_future, *args)
+            except Exception as e:
+                completion.set_exception(e)
+                return
+            chain_future(lane_future, completion)
+        waiting_future.add_done_callback(_resume)
+        return completion
+
+    def new_reply_context(self, event):
+        return ReplyContext(event.reply_token, time.time(), self.reply_token_ttl)
+
+    def send_texts(self, user_id, texts, reply_context=None):
+        messages = [TextMessage(text=chunk) for text in texts for chunk in self._split_text_messages(text)]
+        batches = [messages[i:i + self.LINE_MAX_MESSAGES_PER_REQUEST] for i in range(0, len(messages), self.LINE_MAX_MESSAGES_PER_REQUEST)]
+        if not batches:
+            return
+        reply_token = reply_context.take() if reply_context is not None else None
+        if reply_token:
+            try:
+                self.messaging_api.reply_message(ReplyMessageRequest(reply_token=reply_token, messages=batches[0]))
+                self.metrics.incr("line.reply_messages")
+                batches = batches[1:]
+            except Exception as e:
+                logger.warning(f"使用 reply token 回覆使用者 {user_id} 失敗，改用推播: {e}")
+                self.metrics.incr("line.reply_failures")
+        elif reply_context is not None and reply_context.is_expired():
+            self.metrics.incr("line.reply_token_expired")
+        for batch in batches:
+            self.messaging_api.push_message(PushMessageRequest(to=user_id, messages=batch))
+            self.metrics.incr("line.push_messages")
+
+    def _reupload_history_media(self, media_path, media_meta):
+        with self._history_reuploads_lock:
+            reupload = self._history_reuploads.get(media_path)
+            if reupload is None:
+                reupload = Future()
+                reupload.set_running_or_notify_cancel()
+                try:
+                    self.lane_for("video").submit(time.time() + self.event_processing_budget["video"],
+                                                  self._start_history_media_reupload, media_path, media_meta, reupload)
+                except RuntimeError as e:
+                    logger.warning(f"無法排程重新上傳歷史媒體 {media_path}: {e}")
+                    return None
+                self._history_reuploads[media_path] = reupload
+                self.metrics.incr("history_media.reuploads_queued")
+                return None
+            if not reupload.done():
+                return None
+            del self._history_reuploads[media_path]
+        return reupload.result()
+
+    def _start_history_media_reupload(self, media_path, media_meta, reupload):
+        mime_type = (media_meta or {}).get("mime_type") or ("audio/m4a" if media_path.startswith(str(self.audio_dir)) else "video/mp4")
+        duration_ms = (media_meta or {}).get("duration_ms")
+        try:
+            content_hash = sha256_file(media_path)
+            indexed_file = self.gemini_file_index.lookup(content_hash, size_bytes=os.path.getsize(media_path))
+            if indexed_file is not None:
+                reupload.set_result(dict(indexed_file, duration_ms=duration_ms))
+                return
+            uploaded_file = genai.upload_file(path=media_path, mime_type=mime_type, display_name=Path(media_path).name)
+            ready_future = self.file_poller.watch(uploaded_file, f"歷史媒體 {media_path}")
+        except Exception as e:
+            logger.warning(f"重新上傳歷史媒體 {media_path} 失敗，改以文字替代: {e}")
+            reupload.set_result(None)
+            return
+
+        def _record_active_file(ready):
+            try:
+                indexed_file = self.gemini_file_index.record(content_hash, ready.result())
+            except Exception as e:
+                logger.warning(f"重新上傳歷史媒體 {media_path} 失敗，改以文字替代: {e}")
+                reupload.set_result(None)
+                return
+            self.metrics.incr("history_media.reuploaded")
+            logger.info(f"歷史媒體 {media_path} 已重新上傳，下一輪對話起重新附上")
+            reupload.set_result(dict(indexed_file, duration_ms=duration_ms))
+        ready_future.add_done_callback(_record_active_file)
+
+    def _live_history_media_part(self, turn, media_path):
+        media_meta = turn.get("media", {}).get(media_path)
+        if media_meta and media_meta.get("expires_at", 0) - self.history_media_expiry_margin > time.time():
+            self.metrics.incr("history_media.reattached")
+            return GeminiFileIndex.as_part(media_meta)
+        if not self.history_media_reupload or not Path(media_path).exists():
+            return None
+        media_meta = self._reupload_history_media(media_path, media_meta)
+        if media_meta is None:
+            return None
+        turn.setdefault("media", {})[media_path] = media_meta
+        return GeminiFileIndex.as_part(media_meta)
+
+    LINE_CONTENT_API_BASE = "https://api-data.line.me"
+
+    def download_message_content(self, message_id, dest_path):
+        started_at = time.time()
+        temp_path = dest_path.with_name(f"{dest_path.name}.part")
+        digest = hashlib.sha256()
+        size_bytes = 0
+        with self.http_session.get(
+            f"{self.LINE_CONTENT_API_BASE}/v2/bot/message/{message_id}/content",
+            headers={"Authorization": f"Bearer {self.line_access_token}"},
+            stream=True,
+            timeout=self.media_download_timeout,
+        ) as response:
+            response.raise_for_status()
+            try:
+                content_length = int(response.headers.get("Content-Length") or 0)
+                if content_length > self.media_max_bytes:
+                    raise MediaTooLargeError(f"檔案大小 {content_length} bytes 超過上限 {self.media_max_bytes} bytes")
+                with open(temp_path, "wb") as f:
+                    for chunk in response.iter_content(self.media_download_chunk_bytes):
+                        size_bytes += len(chunk)
+                        if size_bytes > self.media_max_bytes:
+                            raise MediaTooLargeError(f"下載超過上限 {self.media_max_bytes} bytes")
+                        digest.update(chunk)
+                        f.write(chunk)
+                os.replace(temp_path, dest_path)
+            except BaseException:
+                temp_path.unlink(missing_ok=True)
+                raise
+        self.metrics.observe("media_download.seconds", time.time() - started_at)
+        self.metrics.incr("media_download.bytes", size_bytes)
+        return digest.hexdigest(), size_bytes
+
+    def store_user_image(self, user_id, image_bytes):
+        image_type = sniff_image_type(image_bytes)
+        if image_type is None:
+            png_buffer = io.BytesIO()
+            with self.image_loader.open(image_bytes) as image_obj:
+                image_obj.save(png_buffer, 'PNG')
+            image_bytes = png_buffer.getvalue()
+            image_type = ("image/png", "png")
+            self.metrics.incr("images.reencoded")
+        else:
+            self.metrics.incr("images.passthrough")
+        mime_type, file_ext = image_type
+        content_hash = hashlib.sha256(image_bytes).hexdigest()
+        image_path = self.image_dir / f"userimg_{user_id}_{content_hash}.{file_ext}"
+        if image_path.exists():
+            self.metrics.incr("images.duplicate_writes_skipped")
+        else:
+            with open(image_path, "wb") as f:
+                f.write(image_bytes)
+        self.metrics.incr("images.bytes_stored", len(image_bytes))
+        return image_path, self.model_image_part(image_path, image_bytes)
+
+    def model_image_path(self, image_path):
+        image_path = Path(image_path)
+        return image_path.with_name(f"{image_path.stem}.model-{self.image_max_edge}-{self.image_max_pixels}{image_path.suffix}")
+
+    def _create_model_image(self, image_path, image_bytes, derivative_path):
+        started_at = time.time()
+        with self.image_loader.open(image_bytes) as img:
+            target_size = fit_image_size(*img.size, max_edge=self.image_max_edge, max_pixels=self.image_max_pixels)
+            if target_size == img.size:
+                return None
+            img.draft(img.mode, target_size)
+            resized = img.resize(target_size, Image.LANCZOS)
+        output = io.BytesIO()
+        resized.save(output, IMAGE_FORMAT_BY_SUFFIX[image_path.suffix.lower()], quality=85)
+        derivative_bytes = output.getvalue()
+        temp_path = derivative_path.with_name(f"{derivative_path.name}.tmp")
+        with open(temp_path, "wb") as f:
+            f.write(derivative_bytes)
+        os.replace(temp_path, derivative_path)
+        self.metrics.observe("image_resize.seconds", time.time() - started_at)
+        self.metrics.incr("image_resize.derivatives_created")
+        logger.info(f"已建立縮小版圖片 {derivative_path} ({len(image_bytes)} -> {len(derivative_bytes)} bytes)")
+        return derivative_bytes
+
+    def model_image_part(self, image_path, image_bytes=None):
+        image_path = Path(image_path)
+        model_part, source_size = self.image_loader.load(image_path, lambda: self._build_model_image_part(image_path, image_bytes))
+        self.metrics.incr("images.model_bytes_sent", len(model_part['data']))
+        self.metrics.incr("images.bytes_saved", source_size - len(model_part['data']))
+        return model_part
+
+    def _build_model_image_part(self, image_path, image_bytes=None):
+        mime_type = IMAGE_MIME_BY_SUFFIX[image_path.suffix.lower()]
+        if image_bytes is None:
+            image_bytes = image_path.read_bytes()
+        model_bytes = None
+        if self.image_max_edge > 0 or self.image_max_pixels > 0:
+            derivative_path = self.model_image_path(image_path)
+            if derivative_path.exists():
+                model_bytes = derivative_path.read_bytes()
+                self.metrics.incr("image_resize.cache_hits")
+            else:
+                try:
+                    model_bytes = self._create_model_image(image_path, image_bytes, derivative_path)
+                except (OSError, ValueError) as e:
+                    logger.warning(f"縮小圖片 {image_path} 失敗，改送原圖: {e}")
+                    self.metrics.incr("image_resize.errors")
+        if model_bytes is None:
+            model_bytes = image_bytes
+        return {'mime_type': mime_type, 'data': model_bytes}, len(image_bytes)
+
+    def _history_part(self, turn, part_data):
+        if isinstance(part_data, str) and part_data.startswith(str(self.image_dir)):
+            try:
+                img_path = Path(part_data)
+                if img_path.exists():
+                    if img_path.suffix.lower() in IMAGE_MIME_BY_SUFFIX:
+                        return self.model_image_part(img_path)
+                    png_buffer = io.BytesIO()
+                    with self.image_loader.open(img_path) as img:
+                        img.save(png_buffer, 'PNG')
+                    return {'mime_type': 'image/png', 'data': png_buffer.getvalue()}
+                logger.warning(f"歷史圖片未找到: {part_data}, 以文字替代")
+                return f"(圖片已遺失: {Path(part_data).name})"
+            except FileNotFoundError:
+                logger.warning(f"歷史圖片未找到: {part_data}, 以文字替代")
+                return f"(圖片已遺失: {Path(part_data).name})"
+            except Exception as e:
+                logger.error(f"載入歷史圖片失敗 {part_data}: {e}", exc_info=True)
+                return f"(載入歷史圖片錯誤: {Path(part_data).name})"
+        if isinstance(part_data, str) and (part_data.startswith(str(self.audio_dir)) or part_data.startswith(str(self.video_dir))):
+            media_file_path = Path(part_data)
+            media_type = "音訊" if part_data.startswith(str(self.audio_dir)) else "影片"
+            live_media_part = self._live_history_media_part(turn, part_data)
+            if live_media_part is not None:
+                return live_media_part
+            if media_file_path.exists():
+                return f"(歷史{media_type}: {media_file_path.name}，內容未在此輪次重新處理)"
+            return f"(歷史{media_type}已遺失: {media_file_path.name})"
+        return part_data
+
     def _prepare_gemini_history(self, local_history):
         gemini_history_for_api = []
+        distilled_turn_ids = self._distilled_turn_ids(local_history)
         for turn in local_history:
             role = "model" if turn["role"] == "assistant" else turn["role"]
-            if 'message' in turn and 'parts' not in turn:
-                turn['parts'] = [turn['message']]
+            descriptions = turn.get("descriptions", {}) if id(turn) in distilled_turn_ids else {}
             parts_for_gemini = []
             for part_data in turn.get('parts', []):
-                if isinstance(part_data, str) and part_data.startswith(str(self.image_dir)):
-                    try:
-                        img_path = Path(part_data)
-                        if img_path.exists():
-                            img = Image.open(img_path)
-                            parts_for_gemini.append(img)
-                        else:
-                            logger.warning(f"歷史圖片未找到: {part_data}, 以文字替代")
-                            parts_for_gemini.append(f"(圖片已遺失: {Path(part_data).name})")
-                    except FileNotFoundError:
-                        logger.warning(f"歷史圖片未找到: {part_data}, 以文字替代")
-                        parts_for_gemini.append(f"(圖片已遺失: {Path(part_data).name})")
-                    except Exception as e:
-                        logger.error(f"載入歷史圖片失敗 {part_data}: {e}", exc_info=True)
-                        parts_for_gemini.append(f"(載入歷史圖片錯誤: {Path(part_data).name})")
-                elif isinstance(part_data, str) and (part_data.startswith(str(self.audio_dir)) or part_data.startswith(str(self.video_dir))):
-                    media_file_path = Path(part_data)
-                    media_type = "音訊" if part_data.startswith(str(self.audio_dir)) else "影片"
-                    if media_file_path.exists():
-                        parts_for_gemini.append(f"(歷史{media_type}: {media_file_path.name}，內容未在此輪次重新處理)")
-                    else:
-                        parts_for_gemini.append(f"(歷史{media_type}已遺失: {media_file_path.name})")
+                if isinstance(part_data, str) and part_data in descriptions:
+                    parts_for_gemini.append(f"(先前媒體的內容摘要: {descriptions[part_data]})")
+                    self.metrics.incr("media_distill.parts_substituted")
                 else:
-                    parts_for_gemini.append(part_data)
+                    parts_for_gemini.append(self._history_part(turn, part_data))
             if parts_for_gemini and role in ["user", "model"]:
                 gemini_history_for_api.append({'role': role, 'parts': parts_for_gemini})
         return gemini_history_for_api
 
+    def replay_stored_reply(self, user_id, line_message_id, reply_context=None):
+        try:
+            stored_reply = self.event_dedup.get_reply(line_message_id)
+            if stored_reply is None or stored_reply["user_id"] != user_id:
+                self.metrics.incr("replay.misses")
+                return False
+            self.send_texts(user_id, [stored_reply["reply_text"]], reply_context)
+        except Exception as e:
+            self.metrics.incr("replay.errors")
+            logger.error(f"重送事件：重新送出訊息 {line_message_id} 的既有回覆失敗 (User: {user_id}): {e}", exc_info=True)
+            return False
+        self.metrics.incr("replay.served")
+        self.metrics.incr("replay.model_calls_saved")
+        self.metrics.incr("replay.input_tokens_saved", stored_reply["input_tokens"])
+        self.metrics.incr("replay.output_tokens_saved", stored_reply["output_tokens"])
+        logger.info(f"重送事件：已重新送出訊息 {line_message_id} 的既有回覆 (User: {user_id})，未呼叫模型")
+        return True
+
     def _task_done_callback(self, processing_key, event_type, future_obj):
-        with self.processing_lock:
-            if processing_key in self.currently_processing_message_ids:
-                self.currently_processing_message_ids.remove(processing_key)
-                logger.info(f"訊息 {processing_key} ({event_type}) 已處理完成或失敗，從處理隊列中移除。")
-            else:
-                logger.warning(f"任務完成回呼：試圖從處理隊列移除不存在的訊息 {processing_key} ({event_type})。")
+        try:
+            self.event_dedup.complete(processing_key)
+            logger.info(f"事件 {processing_key} ({event_type}) 已處理完成或失敗，標記為已處理。")
+        except sqlite3.Error as e:
+            logger.warning(f"任務完成回呼：標記事件 {processing_key} ({event_type}) 為已處理失敗: {e}")
         try:
             exception = future_obj.exception()
             if exception:
@@ -226,49 +2017,96 @@ class ChatBot:
             logger.error(f"檢查背景任務 (Key: {processing_key}, Type: {event_type}) 異常時發生錯誤: {e}")
 
     def setup_routes(self):
-        def wait_for_file_active(uploaded_file: File, user_id: str, message_id: str) -> File:
-            if not uploaded_file:
-                raise ValueError("No file provided to wait_for_file_active")
-            logger.info(f"等待檔案 {uploaded_file.name} (URI: {uploaded_file.uri}, User: {user_id}, MsgID: {message_id}) 狀態變為 ACTIVE。初始狀態: {uploaded_file.state}")
-            start_time = time.time()
-            while uploaded_file.state == protos.File.State.PROCESSING:
-                if time.time() - start_time > self.file_processing_timeout:
-                    logger.error(f"等待檔案 {uploaded_file.name} (User: {user_id}, MsgID: {message_id}) 變為 ACTIVE 超時 ({self.file_processing_timeout}秒)。")
-                    raise TimeoutError(f"File {uploaded_file.name} (User: {user_id}, MsgID: {message_id}) did not become active in time.")
-                time.sleep(self.file_processing_poll_interval)
+        def _actual_ai_and_history_processing(user_id, event_type, data_for_gemini, storable_parts_for_history, line_message_id, reply_context=None, turn_metadata=None):
+            received_at = reply_context.received_at if reply_context is not None else time.time()
+            first_bubble = []
+
+            def record_first_message_latency(mode):
+                latency = time.time() - received_at
+                self.metrics.observe("reply.time_to_first_message_seconds", latency)
+                logger.info(f"首則回覆送出 (User: {user_id}, MsgID: {line_message_id}, 模式: {mode})，耗時 {latency:.2f}s")
+
+            def deliver_first_bubble(text):
                 try:
-                    uploaded_file = genai.get_file(name=uploaded_file.name)
+                    self.send_texts(user_id, [text], reply_context)
                 except Exception as e:
-                    logger.error(f"獲取檔案 {uploaded_file.name} (User: {user_id}, MsgID: {message_id}) 狀態時出錯: {e}", exc_info=True)
-                    raise
-                logger.info(f"檔案 {uploaded_file.name} (User: {user_id}, MsgID: {message_id}) 當前狀態: {uploaded_file.state}")
-            if uploaded_file.state != protos.File.State.ACTIVE:
-                logger.error(f"檔案 {uploaded_file.name} (User: {user_id}, MsgID: {message_id}) 未處於 ACTIVE 狀態。最終狀態: {uploaded_file.state}")
-                if hasattr(uploaded_file, 'error') and uploaded_file.error:
-                    logger.error(f"檔案 {uploaded_file.name} (User: {user_id}, MsgID: {message_id}) 處理失敗: {uploaded_file.error}")
-                raise Exception(f"File {uploaded_file.name} (User: {user_id}, MsgID: {message_id}) is not active (state: {uploaded_file.state}). Cannot use for generation.")
-            logger.info(f"檔案 {uploaded_file.name} (User: {user_id}, MsgID: {message_id}) 已處於 ACTIVE 狀態。")
-            return uploaded_file
-
-        def _actual_ai_and_history_processing(user_id, event_type, data_for_gemini, storable_parts_for_history, line_message_id):
+                    logger.error(f"推送串流首則回覆給使用者 {user_id} (MsgID: {line_message_id}) 失敗: {e}", exc_info=True)
+                    return
+                first_bubble.append(text)
+                self.metrics.incr("reply.streamed_first_bubbles")
+                record_first_message_latency("stream")
+
             with self.user_history_locks[user_id]:
                 logger.info(f"取得使用者 {user_id} 的歷史鎖 (MsgID: {line_message_id})")
                 history = self.load_chat_history(user_id)
-                gemini_history_for_api = self._prepare_gemini_history(history)
-                ai_reply = self.get_ai_response(user_id, gemini_history_for_api, data_for_gemini)
-                history.append({"role": "user", "parts": storable_parts_for_history})
-                history.append({"role": "assistant", "parts": [ai_reply]})
-                history = self.manage_chat_history(history)
-                self.save_chat_history(user_id, history)
+                prompt_tokens = history.total_tokens
+                try:
+                    gemini_history_for_api = self._prepare_gemini_history(history)
+                    model_started_at = time.time()
+                    ai_reply = self.get_ai_response(user_id, gemini_history_for_api, data_for_gemini, on_first_bubble=deliver_first_bubble)
+                    self.metrics.observe(f"gemini.{event_type}.response_seconds", time.time() - model_started_at)
+                    new_turns = [
+                        {"role": "user", "parts": storable_parts_for_history, "message_id": line_message_id, **(turn_metadata or {})},
+                        {"role": "assistant", "parts": [ai_reply]},
+                    ]
+                    history.extend(new_turns)
+                    history = self.manage_chat_history(history)
+                except Exception:
+                    self.history_cache.invalidate(user_id)
+                    raise
+                self.commit_chat_history(user_id, history, new_turns)
                 logger.info(f"釋放使用者 {user_id} 的歷史鎖 (MsgID: {line_message_id})")
+            for replied_message_id in (turn_metadata or {}).get("message_ids", [line_message_id]):
+                try:
+                    self.event_dedup.record_reply(replied_message_id, user_id, ai_reply,
+                                                  prompt_tokens + new_turns[0]["tokens"], new_turns[1]["tokens"])
+                except sqlite3.Error as e:
+                    logger.warning(f"儲存訊息 {replied_message_id} 的回覆以供重送失敗: {e}")
+            if self.token_count_pool is not None:
+                self.token_count_pool.submit(self.calibrate_turn_tokens, user_id, history, new_turns)
+            if self.media_distill_pool is not None and self.media_part_paths(new_turns[0]):
+                self.media_distill_pool.submit(self.distill_turn_media, user_id, new_turns[0])
+            remaining_reply = ai_reply[len(first_bubble[0]):].strip() if first_bubble else ai_reply
+            if not remaining_reply:
+                return
             try:
-                self.messaging_api.push_message(
-                    PushMessageRequest(to=user_id, messages=[TextMessage(text=ai_reply)])
-                )
+                self.send_texts(user_id, [remaining_reply], reply_context)
+                if not first_bubble:
+                    record_first_message_latency("full")
             except Exception as e:
                 logger.error(f"推送 AI 回覆給使用者 {user_id} (MsgID: {line_message_id}) 失敗: {e}", exc_info=True)
 
-        def full_background_task_for_event(user_id, event_type, line_message_id, raw_event_data=None):
+        def report_background_failure(user_id, event_type, line_message_id, e, reply_context=None):
+            logger.error(f"完整背景任務 (User: {user_id}, Type: {event_type}, MsgID: {line_message_id}) 發生錯誤: {e}", exc_info=e)
+            error_msg_text = "抱歉，處理您的請求時發生了一點問題。"
+            if isinstance(e, TimeoutError):
+                error_msg_text = f"抱歉，處理您的{event_type}檔案時超時，請稍後再試。"
+            elif isinstance(e, MediaTooLargeError):
+                error_msg_text = f"抱歉，您傳送的{event_type}檔案太大，無法處理。"
+            elif "Unsupported" in str(e) or "mime_type" in str(e).lower() or "not supported" in str(e).lower():
+                 error_msg_text = f"抱歉，您傳送的{event_type}檔案類型可能不受支援或處理失敗。"
+            elif "quota" in str(e).lower():
+                error_msg_text = "已達到服務的使用額度限制，請稍後再試。"
+            elif "API key not valid" in str(e):
+                error_msg_text = "服務設定錯誤，請聯繫管理員。"
+            elif "SAFETY" in str(e).upper():
+                error_msg_text = "抱歉，您的請求可能包含不適當的內容，我無法處理。"
+            try:
+                self.send_texts(user_id, [error_msg_text], reply_context)
+            except Exception as push_e:
+                logger.error(f"背景任務失敗後，推播錯誤訊息也失敗 (User: {user_id}, MsgID: {line_message_id}): {push_e}", exc_info=True)
+
+        def continue_after_file_ready(ready_future, user_id, event_type, line_message_id, media_prompt, media_path, content_hash, duration_ms, reply_context=None):
+            try:
+                active_media_file = ready_future.result()
+                indexed_file = self.gemini_file_index.record(content_hash, active_media_file)
+                turn_metadata = {"media": {str(media_path): dict(indexed_file, duration_ms=duration_ms)}}
+                _actual_ai_and_history_processing(user_id, event_type, [media_prompt, active_media_file], [media_prompt, str(media_path)],
+                                                  line_message_id, reply_context, turn_metadata)
+            except Exception as e:
+                report_background_failure(user_id, event_type, line_message_id, e, reply_context)
+
+        def full_background_task_for_event(user_id, event_type, line_message_id, raw_event_data=None, reply_context=None):
             try:
                 logger.info(f"背景任務開始: User {user_id}, Type {event_type}, MsgID {line_message_id}")
                 user_content_for_gemini = []
@@ -281,36 +2119,74 @@ class ChatBot:
                 elif event_type == 'image':
                     logger.info(f"背景下載圖片: User {user_id}, MsgID {line_message_id}")
                     image_bytes = self.messaging_api_blob.get_message_content(message_id=line_message_id)
-                    image_obj = Image.open(io.BytesIO(image_bytes))
-                    filename_ts = datetime.now().strftime('%Y%m%d%H%M%S%f')
-                    filename = f"userimg_{user_id}_{filename_ts}.png"
-                    image_path = self.image_dir / filename
-                    image_obj.save(image_path, 'PNG')
+                    image_path, image_part = self.store_user_image(user_id, image_bytes)
                     logger.info(f"圖片已儲存於: {image_path} (User: {user_id}, MsgID: {line_message_id})")
                     
                     image_specific_prompt = "這是一張圖片。如果圖片中有文字，也請一併識別。"
                     full_image_prompt = f"{contextual_media_prompt_prefix}\n{image_specific_prompt}"
                     
-                    user_content_for_gemini = [full_image_prompt, image_obj]
+                    user_content_for_gemini = [full_image_prompt, image_part]
                     storable_parts_for_history = [full_image_prompt, str(image_path)]
 
+                elif event_type == 'batch':
+                    message_ids = [item["line_message_id"] for item in raw_event_data]
+                    logger.info(f"合併處理 {len(message_ids)} 則訊息: User {user_id}, MsgIDs {message_ids}")
+                    if all(item["event_type"] == 'image' for item in raw_event_data):
+                        batch_prompt = f"用戶一次傳送了 {len(message_ids)} 張圖片，請結合我們之前的對話內容，將這些圖片視為一組一併理解並回應；圖片中若有文字也請一併識別："
+                    else:
+                        batch_prompt = f"用戶連續傳送了 {len(message_ids)} 則訊息，請結合我們之前的對話內容，將它們視為同一段發言一併回應；圖片中若有文字也請一併識別："
+                    user_content_for_gemini = [batch_prompt]
+                    storable_parts_for_history = [batch_prompt]
+                    image_downloads = {
+                        item["line_message_id"]: self.content_download_pool.submit(self.messaging_api_blob.get_message_content, message_id=item["line_message_id"])
+                        for item in raw_event_data if item["event_type"] == 'image'
+                    }
+                    for item in raw_event_data:
+                        if item["event_type"] == 'image':
+                            image_bytes = image_downloads[item["line_message_id"]].result()
+                            image_path, image_part = self.store_user_image(user_id, image_bytes)
+                            logger.info(f"圖片已儲存於: {image_path} (User: {user_id}, MsgID: {item['line_message_id']})")
+                            user_content_for_gemini.append(image_part)
+                            storable_parts_for_history.append(str(image_path))
+                        else:
+                            user_content_for_gemini.append(item["raw_event_data"])
+                            storable_parts_for_history.append(item["raw_event_data"])
+                    _actual_ai_and_history_processing(user_id, event_type, user_content_for_gemini, storable_parts_for_history,
+                                                      line_message_id, reply_context, {"message_ids": message_ids})
+                    return
+
                 elif event_type == 'sticker':
-                    sticker_image_bytes, package_id, sticker_id = raw_event_data
+                    package_id, sticker_id = raw_event_data
                     
                     sticker_base_info = f"用戶發送了一個 LINE 貼圖 (Package ID: {package_id}, Sticker ID: {sticker_id})。"
                     sticker_specific_prompt = "這是一個貼圖。請描述它並推測用戶的情感或意圖。"
+                    sticker_image_bytes = None
+                    sticker_entry = self.sticker_cache.get(package_id, sticker_id)
+                    if sticker_entry is None:
+                        sticker_image_bytes = self.sticker_cache.load_image(package_id, sticker_id)
+                    if sticker_entry is None and sticker_image_bytes is None:
+                        sticker_image_bytes = self.fetch_sticker_image(package_id, sticker_id)
+                    if sticker_entry is None and not sticker_image_bytes:
+                        logger.warning(f"無法下載貼圖 {package_id}/{sticker_id} (MsgID: {line_message_id}, User: {user_id}) 的圖片。")
+                    if sticker_entry is None and sticker_image_bytes:
+                        sticker_entry = self.cache_sticker(package_id, sticker_id, sticker_image_bytes)
                     
-                    if sticker_image_bytes:
+                    if sticker_entry is not None:
+                        full_sticker_prompt = (f"{contextual_media_prompt_prefix}\n{sticker_base_info} "
+                                               f"貼圖內容描述：{sticker_entry['description']}\n請根據貼圖內容推測用戶的情感或意圖並回應。")
+                        user_content_for_gemini = [full_sticker_prompt]
+                        storable_parts_for_history = [full_sticker_prompt]
+                    elif sticker_image_bytes:
                         try:
-                            sticker_obj = Image.open(io.BytesIO(sticker_image_bytes))
                             filename_ts = datetime.now().strftime('%Y%m%d%H%M%S%f')
                             filename = f"sticker_{user_id}_{package_id}_{sticker_id}_{filename_ts}.png"
                             sticker_path = self.image_dir / filename
-                            sticker_obj.save(sticker_path, 'PNG')
+                            with self.image_loader.open(sticker_image_bytes) as sticker_obj:
+                                sticker_obj.save(sticker_path, 'PNG')
                             logger.info(f"貼圖已儲存於: {sticker_path} (User: {user_id}, MsgID: {line_message_id})")
                             
                             full_sticker_prompt = f"{contextual_media_prompt_prefix}\n{sticker_base_info} {sticker_specific_prompt} 圖片內容如下。"
-                            user_content_for_gemini = [full_sticker_prompt, sticker_obj]
+                            user_content_for_gemini = [full_sticker_prompt, self.model_image_part(sticker_path)]
                             storable_parts_for_history = [full_sticker_prompt, str(sticker_path)]
                         except Exception as e:
                             logger.error(f"處理下載的貼圖圖片失敗 (User: {user_id}, MsgID: {line_message_id}): {e}", exc_info=True)
@@ -328,52 +2204,42 @@ class ChatBot:
                     mime_type = f"audio/{file_ext}" if event_type == 'audio' else f"video/{file_ext}"
                     media_dir = self.audio_dir if event_type == 'audio' else self.video_dir
                     logger.info(f"背景下載{media_type_str_display}: User {user_id}, MsgID {line_message_id}")
-                    media_bytes = self.messaging_api_blob.get_message_content(message_id=line_message_id)
                     ts_filename_part = datetime.now().strftime('%Y%m%d%H%M%S%f')
                     filename = f"user{event_type}_{user_id}_{ts_filename_part}_{line_message_id}.{file_ext}"
                     media_path = media_dir / filename
-                    with open(media_path, "wb") as f:
-                        f.write(media_bytes)
-                    logger.info(f"{media_type_str_display}檔案已儲存於: {media_path} (User: {user_id}, MsgID: {line_message_id})")
+                    content_hash, media_size = self.download_message_content(line_message_id, media_path)
+                    logger.info(f"{media_type_str_display}檔案已儲存於: {media_path} ({media_size} bytes, User: {user_id}, MsgID: {line_message_id})")
                     
                     media_specific_prompt = f"這是{media_type_str_display}。"
                     full_media_prompt = f"{contextual_media_prompt_prefix}\n{media_specific_prompt}"
                     
+                    storable_parts_for_history = [full_media_prompt, str(media_path)]
+                    duration_ms = raw_event_data
+                    indexed_file = self.gemini_file_index.lookup(content_hash, size_bytes=media_size)
+                    if indexed_file is not None:
+                        logger.info(f"重用已上傳的 Gemini 檔案 {indexed_file['name']} (User: {user_id}, MsgID: {line_message_id})")
+                        user_content_for_gemini = [full_media_prompt, GeminiFileIndex.as_part(indexed_file)]
+                        turn_metadata = {"media": {str(media_path): dict(indexed_file, duration_ms=duration_ms)}}
+                        _actual_ai_and_history_processing(user_id, event_type, user_content_for_gemini, storable_parts_for_history,
+                                                          line_message_id, reply_context, turn_metadata)
+                        return
                     uploaded_media_file = genai.upload_file(path=media_path, mime_type=mime_type, display_name=filename)
-                    active_media_file = wait_for_file_active(uploaded_media_file, user_id, line_message_id)
-                    
-                    user_content_for_gemini = [full_media_prompt, active_media_file]
-
-                    history_media_text = f"用戶發送了{media_type_str_display}（檔案：{filename}）。"
-                    storable_parts_for_history = [full_media_prompt, str(media_path)] 
-
-
+                    ready_future = self.file_poller.watch(uploaded_media_file, f"User: {user_id}, MsgID: {line_message_id}")
+                    return self.resume_in_lane(ready_future, event_type, continue_after_file_ready, user_id, event_type,
+                                               line_message_id, full_media_prompt, media_path, content_hash, duration_ms, reply_context)
                 else:
                     logger.warning(f"未知的事件類型給背景任務 (User: {user_id}, MsgID: {line_message_id}): {event_type}")
                     return
                 if not user_content_for_gemini:
                     logger.warning(f"事件類型 {event_type} (User: {user_id}, MsgID: {line_message_id}) 未能成功準備 Gemini 內容。")
                     return
-                _actual_ai_and_history_processing(user_id, event_type, user_content_for_gemini, storable_parts_for_history, line_message_id)
-            except (TimeoutError, Exception) as e:
-                logger.error(f"完整背景任務 (User: {user_id}, Type: {event_type}, MsgID: {line_message_id}) 發生錯誤: {e}", exc_info=True)
-                error_msg_text = "抱歉，處理您的請求時發生了一點問題。"
-                if isinstance(e, TimeoutError):
-                    error_msg_text = f"抱歉，處理您的{event_type}檔案時超時，請稍後再試。"
-                elif "Unsupported" in str(e) or "mime_type" in str(e).lower() or "not supported" in str(e).lower():
-                     error_msg_text = f"抱歉，您傳送的{event_type}檔案類型可能不受支援或處理失敗。"
-                elif "quota" in str(e).lower():
-                    error_msg_text = "已達到服務的使用額度限制，請稍後再試。"
-                elif "API key not valid" in str(e):
-                    error_msg_text = "服務設定錯誤，請聯繫管理員。"
-                elif "SAFETY" in str(e).upper():
-                    error_msg_text = "抱歉，您的請求可能包含不適當的內容，我無法處理。"
-                try:
-                    self.messaging_api.push_message(
-                        PushMessageRequest(to=user_id, messages=[TextMessage(text=error_msg_text)])
-                    )
-                except Exception as push_e:
-                    logger.error(f"背景任務失敗後，推播錯誤訊息也失敗 (User: {user_id}, MsgID: {line_message_id}): {push_e}", exc_info=True)
+                _actual_ai_and_history_processing(user_id, event_type, user_content_for_gemini, storable_parts_for_history, line_message_id, reply_context)
+            except Exception as e:
+                report_background_failure(user_id, event_type, line_message_id, e, reply_context)
+
+        @self.app.route("/metrics", methods=["GET"])
+        def metrics():
+            return jsonify(self.metrics.snapshot())
 
         @self.app.route("/callback", methods=["POST"])
         def callback():
@@ -390,32 +2256,104 @@ class ChatBot:
                 abort(500)
             return "OK"
 
-        def _initiate_background_processing(user_id, event_type, line_message_id, raw_event_data=None):
-            processing_key = line_message_id
-            with self.processing_lock:
-                if processing_key in self.currently_processing_message_ids:
-                    logger.info(f"訊息 {processing_key} ({event_type}, User: {user_id}) 已在處理中，忽略此重複觸發。")
-                    return
-                self.currently_processing_message_ids.add(processing_key)
-                logger.info(f"訊息 {processing_key} ({event_type}, User: {user_id}) 加入處理隊列，準備提交給執行緒池。")
-            try:
-                future = self.thread_pool.submit(full_background_task_for_event, user_id, event_type, line_message_id, raw_event_data)
-                future.add_done_callback(
-                    lambda f: self._task_done_callback(processing_key, event_type, f)
-                )
-            except Exception as e:
-                logger.error(f"提交任務到執行緒池失敗 (Key: {processing_key}, Type: {event_type}, User: {user_id}): {e}", exc_info=True)
-                with self.processing_lock:
-                    if processing_key in self.currently_processing_message_ids:
-                        self.currently_processing_message_ids.remove(processing_key)
-                        logger.info(f"因提交失敗，訊息 {processing_key} ({event_type}) 已從處理隊列中移除。")
+        def _submit_background_job(user_id, event_type, line_message_id, raw_event_data, reply_context, processing_keys, lane_event_type=None):
+            lane_event_type = lane_event_type or event_type
+
+            def start_job():
                 try:
-                    self.messaging_api.push_message(
-                        PushMessageRequest(to=user_id, messages=[TextMessage(text="系統繁忙，請稍後再試。")])
+                    future = self.lane_for(lane_event_type).submit(self.job_deadline(lane_event_type, reply_context), full_background_task_for_event,
+                                                                   user_id, event_type, line_message_id, raw_event_data, reply_context)
+                except Exception as e:
+                    report_submit_failure(e)
+                    raise
+                for processing_key in processing_keys:
+                    future.add_done_callback(
+                        lambda f, processing_key=processing_key: self._task_done_callback(processing_key, event_type, f)
                     )
+                return future
+
+            def report_submit_failure(e):
+                logger.error(f"提交任務到執行緒池失敗 (Keys: {processing_keys}, Type: {event_type}, User: {user_id}): {e}", exc_info=True)
+                for processing_key in processing_keys:
+                    try:
+                        self.event_dedup.release(processing_key)
+                        logger.info(f"因提交失敗，事件 {processing_key} ({event_type}) 已釋放，重送時可再處理。")
+                    except sqlite3.Error as release_e:
+                        logger.warning(f"釋放事件 {processing_key} 失敗: {release_e}")
+                try:
+                    self.send_texts(user_id, ["系統繁忙，請稍後再試。"], reply_context)
                 except Exception as push_e:
                      logger.error(f"提交任務失敗後，推播錯誤訊息也失敗 (User: {user_id}, MsgID: {line_message_id}): {push_e}", exc_info=True)
 
+            self.mailboxes.submit(user_id, start_job)
+
+        def _submit_coalesced_messages(user_id, items):
+            if len(items) == 1:
+                item = items[0]
+                _submit_background_job(user_id, item["event_type"], item["line_message_id"], item["raw_event_data"],
+                                       item["reply_context"], [item["processing_key"]])
+                return
+            lane_event_type = "image" if any(item["event_type"] == "image" for item in items) else "text"
+            logger.info(f"合併使用者 {user_id} 的 {len(items)} 則連續訊息為一次 AI 呼叫")
+            _submit_background_job(user_id, 'batch', items[-1]["line_message_id"], items, items[-1]["reply_context"],
+                                   [item["processing_key"] for item in items], lane_event_type=lane_event_type)
+
+        def _submit_image_set(image_set_key, items):
+            user_id = image_set_key[0]
+            items = sorted(items, key=lambda item: item["image_set_index"] or 0)
+            if len(items) == 1:
+                _submit_coalesced_messages(user_id, items)
+                return
+            logger.info(f"圖片組 {image_set_key[1]} (User: {user_id}) 已收齊 {len(items)} 張，合併為一次 AI 呼叫")
+            _submit_background_job(user_id, 'batch', items[-1]["line_message_id"], items, items[-1]["reply_context"],
+                                   [item["processing_key"] for item in items], lane_event_type="image")
+
+        self.image_set_assembler = MessageCoalescer(
+            "image_sets", _submit_image_set, self.metrics,
+            window=self.image_set_timeout, max_wait=self.image_set_timeout, max_batch=self.image_set_max_images,
+        )
+
+        if self.coalesce_window > 0:
+            self.message_coalescer = MessageCoalescer(
+                "messages", _submit_coalesced_messages, self.metrics,
+                window=self.coalesce_window, max_wait=self.coalesce_max_wait, max_batch=self.coalesce_max_batch,
+            )
+            logger.info(f"訊息合併已啟用: 視窗 {self.coalesce_window}s，最長等待 {self.coalesce_max_wait}s，"
+                        f"最多 {self.coalesce_max_batch} 則，類型 {sorted(self.coalesce_event_types)}")
+
+        def _initiate_background_processing(user_id, event_type, line_message_id, raw_event_data=None, reply_context=None, event_id=None,
+                                            redelivery=False, image_set=None):
+            processing_key = event_id or line_message_id
+            try:
+                claimed = self.event_dedup.claim(processing_key)
+            except sqlite3.Error as e:
+                logger.error(f"Webhook 去重資料庫錯誤，仍繼續處理事件 {processing_key}: {e}")
+                claimed = True
+            if not claimed:
+                logger.info(f"事件 {processing_key} ({event_type}, User: {user_id}, MsgID: {line_message_id}) 已處理或處理中，忽略此重複觸發。")
+                if redelivery:
+                    self.lane_for("text").submit(self.job_deadline("text", reply_context), self.replay_stored_reply,
+                                                 user_id, line_message_id, reply_context)
+                return
+            item = {
+                "event_type": event_type,
+                "line_message_id": line_message_id,
+                "raw_event_data": raw_event_data,
+                "reply_context": reply_context,
+                "processing_key": processing_key,
+            }
+            if image_set is not None and (image_set.total or 0) > 1:
+                item["image_set_index"] = image_set.index
+                self.image_set_assembler.add((user_id, image_set.id), item, expected=min(image_set.total, self.image_set_max_images))
+                logger.info(f"事件 {processing_key} 為圖片組 {image_set.id} 的第 {image_set.index}/{image_set.total} 張，等待其餘圖片。")
+                return
+            if self.message_coalescer is not None and event_type in self.coalesce_event_types:
+                self.message_coalescer.add(user_id, item)
+                logger.info(f"事件 {processing_key} ({event_type}, User: {user_id}) 進入合併視窗。")
+                return
+            logger.info(f"事件 {processing_key} ({event_type}, User: {user_id}) 加入處理隊列，準備提交給執行緒池。")
+            _submit_background_job(user_id, event_type, line_message_id, raw_event_data, reply_context, [processing_key])
+
         @self.handler.add(MessageEvent, message=TextMessageContent)
         def handle_text_message(event):
             user_id = event.source.user_id
@@ -433,6 +2371,7 @@ class ChatBot:
                 user_prompt_file = self.prompts_dir / f"user_{user_id}.txt"
                 try:
                     user_prompt_file.write_text(user_msg, encoding="utf-8")
+                    self.prompt_cache.pop(str(user_prompt_file))
                     prompt_flag_file.unlink(missing_ok=True)
                     reply_sync("✅ 系統提示詞已更新！")
                 except IOError as e:
@@ -453,6 +2392,7 @@ class ChatBot:
                 if prompt_path.exists():
                     try:
                         prompt_path.unlink(missing_ok=True)
+                        self.prompt_cache.pop(str(prompt_path))
                         reply_sync("✅ 已清除使用者提示詞，恢復為預設提示詞。")
                     except OSError as e:
                         logger.error(f"清除使用者提示詞檔案失敗 (User: {user_id}): {e}", exc_info=True)
@@ -463,37 +2403,36 @@ class ChatBot:
             if user_msg == "/bye":
                 with self.user_history_locks[user_id]:
                     logger.info(f"取得使用者 {user_id} 的歷史鎖 (MsgID: {line_message_id}, Action: /bye)")
-                    history_path = self.history_dir / f"user_{user_id}.json"
-                    if history_path.exists():
-                        try:
-                            old_history_content = self.load_chat_history(user_id)
-                            for turn in old_history_content:
-                                for part_data in turn.get('parts', []):
-                                    if isinstance(part_data, str):
-                                        part_path_obj = Path(part_data)
-                                        if (part_data.startswith(str(self.image_dir)) or
-                                           part_data.startswith(str(self.audio_dir)) or
-                                           part_data.startswith(str(self.video_dir))):
-                                            try:
-                                                part_path_obj.unlink(missing_ok=True)
-                                                logger.info(f"清除歷史時刪除媒體檔案: {part_data} (User: {user_id})")
-                                            except OSError as e:
-                                                logger.warning(f"清除歷史媒體檔案時發生錯誤 {part_data} (User: {user_id}): {e}")
-                            history_path.unlink(missing_ok=True)
-                        except Exception as e:
-                            logger.error(f"清除歷史檔案 {history_path} (User: {user_id}) 失敗: {e}", exc_info=True)
+                    try:
+                        old_history_content = self.load_chat_history(user_id)
+                        for turn in old_history_content:
+                            for part_data in turn.get('parts', []):
+                                if isinstance(part_data, str):
+                                    try:
+                                        if self.delete_media_file(part_data):
+                                            logger.info(f"清除歷史時刪除媒體檔案: {part_data} (User: {user_id})")
+                                    except OSError as e:
+                                        logger.warning(f"清除歷史媒體檔案時發生錯誤 {part_data} (User: {user_id}): {e}")
+                        self.clear_chat_history(user_id)
+                    except Exception as e:
+                        logger.error(f"清除歷史紀錄 (User: {user_id}) 失敗: {e}", exc_info=True)
                     logger.info(f"釋放使用者 {user_id} 的歷史鎖 (MsgID: {line_message_id}, Action: /bye)")
                 reply_sync("🗑️ 已清除你的聊天紀錄與相關媒體檔案，從頭開始囉！")
                 return
             logger.info(f"收到來自 {user_id} 的文字訊息 (ID: {line_message_id})，準備背景 AI 處理。")
-            _initiate_background_processing(user_id, 'text', line_message_id, raw_event_data=user_msg)
+            _initiate_background_processing(user_id, 'text', line_message_id, raw_event_data=user_msg,
+                                           reply_context=self.new_reply_context(event), event_id=event.webhook_event_id,
+                                           redelivery=event.delivery_context.is_redelivery)
 
         @self.handler.add(MessageEvent, message=ImageMessageContent)
         def handle_image_message(event):
             user_id = event.source.user_id
             line_message_id = event.message.id
             logger.info(f"收到來自 {user_id} 的圖片訊息 (ID: {line_message_id})，準備背景處理。")
-            _initiate_background_processing(user_id, 'image', line_message_id)
+            _initiate_background_processing(user_id, 'image', line_message_id, reply_context=self.new_reply_context(event),
+                                           event_id=event.webhook_event_id,
+                                           redelivery=event.delivery_context.is_redelivery,
+                                           image_set=event.message.image_set)
 
         @self.handler.add(MessageEvent, message=StickerMessageContent)
         def handle_sticker_message(event):
@@ -501,44 +2440,59 @@ class ChatBot:
             package_id = event.message.package_id
             sticker_id = event.message.sticker_id
             line_message_id = event.message.id
+            reply_context = self.new_reply_context(event)
             logger.info(f"收到來自 {user_id} 的貼圖訊息 (ID: {line_message_id}), PkgID: {package_id}, StickerID: {sticker_id}。")
-            sticker_image_bytes = None
-            urls_to_try = [
-                f"https://stickershop.line-scdn.net/stickershop/v1/sticker/{sticker_id}/ANDROID/sticker.png",
-                f"https://stickershop.line-scdn.net/stickershop/v1/sticker/{sticker_id}/IOS/sticker.png",
-                f"https://stickershop.line-scdn.net/stickershop/v1/sticker/{sticker_id}/STATIC/sticker.png"
-            ]
-            for s_url in urls_to_try:
-                try:
-                    response = requests.get(s_url, timeout=10)
-                    response.raise_for_status()
-                    if response.content:
-                        sticker_image_bytes = response.content
-                        logger.info(f"成功從 {s_url} 下載貼圖圖片 ({len(sticker_image_bytes)} bytes) for MsgID {line_message_id}")
-                        break
-                except requests.exceptions.RequestException as e:
-                    logger.warning(f"下載貼圖圖片時發生網路請求錯誤 ({s_url}) for MsgID {line_message_id}: {e}")
-            if not sticker_image_bytes:
-                logger.warning(f"無法下載貼圖 {package_id}/{sticker_id} (MsgID: {line_message_id}, User: {user_id}) 的圖片。")
             _initiate_background_processing(user_id, 'sticker', line_message_id,
-                                           raw_event_data=(sticker_image_bytes, package_id, sticker_id))
+                                           raw_event_data=(package_id, sticker_id),
+                                           reply_context=reply_context, event_id=event.webhook_event_id,
+                                           redelivery=event.delivery_context.is_redelivery)
 
         @self.handler.add(MessageEvent, message=AudioMessageContent)
         def handle_audio_message(event):
             user_id = event.source.user_id
             line_message_id = event.message.id
             logger.info(f"收到來自 {user_id} 的語音訊息 (ID: {line_message_id})，準備背景處理。")
-            _initiate_background_processing(user_id, 'audio', line_message_id)
+            _initiate_background_processing(user_id, 'audio', line_message_id, raw_event_data=event.message.duration,
+                                           reply_context=self.new_reply_context(event), event_id=event.webhook_event_id,
+                                           redelivery=event.delivery_context.is_redelivery)
 
         @self.handler.add(MessageEvent, message=VideoMessageContent)
         def handle_video_message(event):
             user_id = event.source.user_id
             line_message_id = event.message.id
             logger.info(f"收到來自 {user_id} 的影片訊息 (ID: {line_message_id})，準備背景處理。")
-            _initiate_background_processing(user_id, 'video', line_message_id)
+            _initiate_background_processing(user_id, 'video', line_message_id, raw_event_data=event.message.duration,
+                                           reply_context=self.new_reply_context(event), event_id=event.webhook_event_id,
+                                           redelivery=event.delivery_context.is_redelivery)
+
+    def shutdown(self):
+        if self._shutdown_done:
+            return
+        self._shutdown_done = True
+        logger.info("聊天機器人關閉中，寫入待儲存的歷史紀錄並等待背景任務完成...")
+        self.history_store.flush()
+        self.image_set_assembler.close()
+        if self.message_coalescer is not None:
+            self.message_coalescer.close()
+        self.file_poller.close()
+        for lane in self.lanes.values():
+            lane.shutdown(wait=False)
+        for lane in self.lanes.values():
+            lane.shutdown(wait=True)
+        if self.token_count_pool is not None:
+            self.token_count_pool.shutdown(wait=False, cancel_futures=True)
+        if self.media_distill_pool is not None:
+            self.media_distill_pool.shutdown(wait=False, cancel_futures=True)
+        self.sticker_fetch_pool.shutdown(wait=False, cancel_futures=True)
+        self.content_download_pool.shutdown(wait=False, cancel_futures=True)
+        self.http_session.close()
+        self.event_dedup.close()
+        self.history_store.close()
+        logger.info("聊天機器人已關閉。")
 
     def run(self, host="0.0.0.0", port=5566):
         logger.info(f"聊天機器人啟動於 http://{host}:{port}")
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
         self.app.run(host=host, port=port, threaded=True)
 
 if __name__ == "__main__":
@@ -0,0 +1,65 @@
+import os
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+warnings.simplefilter("ignore")
+
+from app import ConversationWindow
+
+HISTORY_LENGTHS = [100, 1000, 10000, 50000]
+MESSAGES_PER_RUN = 200
+TURN_TEXT = "這是一段測試用的對話內容，用來模擬一般長度的訊息。" * 2
+
+
+def make_turns(count):
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "parts": [f"{TURN_TEXT}{i}"]}
+        for i in range(count)
+    ]
+
+
+def legacy_manage(history, max_tokens):
+    total_tokens = sum(len(str(part)) for turn in history for part in turn.get('parts', []))
+    while total_tokens > max_tokens and len(history) > 1:
+        removed_turn = history.pop(0)
+        total_tokens -= sum(len(str(part)) for part in removed_turn.get('parts', []))
+    return history
+
+
+def window_manage(history, max_tokens):
+    history.trim_to_budget(max_tokens)
+    return history
+
+
+def per_message_cost(history, manage, max_tokens):
+    new_turns = make_turns(MESSAGES_PER_RUN * 2)
+    start = time.perf_counter()
+    for i in range(MESSAGES_PER_RUN):
+        history.extend([dict(t) for t in new_turns[i * 2:i * 2 + 2]])
+        history = manage(history, max_tokens)
+    return (time.perf_counter() - start) / MESSAGES_PER_RUN
+
+
+def backlog_trim_cost(history, manage):
+    start = time.perf_counter()
+    manage(history, 0)
+    return time.perf_counter() - start
+
+
+def main():
+    print(f"{'turns':>8} | {'legacy/msg':>12} | {'window/msg':>12} | {'legacy trim-all':>16} | {'window trim-all':>16}")
+    print("-" * 76)
+    for length in HISTORY_LENGTHS:
+        budget = sum(len(str(p)) for t in make_turns(length) for p in t["parts"])
+        legacy_msg = per_message_cost(make_turns(length), legacy_manage, budget)
+        window_msg = per_message_cost(ConversationWindow(make_turns(length)), window_manage, budget)
+        legacy_trim = backlog_trim_cost(make_turns(length), legacy_manage)
+        window_trim = backlog_trim_cost(ConversationWindow(make_turns(length)), window_manage)
+        print(f"{length:>8} | {legacy_msg * 1e6:>10.1f}us | {window_msg * 1e6:>10.1f}us | "
+              f"{legacy_trim * 1e3:>14.2f}ms | {window_trim * 1e3:>14.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
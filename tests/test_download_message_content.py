@@ -0,0 +1,95 @@
+import hashlib
+import os
+import sys
+import types
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app import ChatBot, MediaTooLargeError, Metrics
+
+
+class FakeStreamingResponse:
+    def __init__(self, chunks, content_length=None):
+        self.chunks = chunks
+        self.headers = {} if content_length is None else {"Content-Length": str(content_length)}
+        self.requested_chunk_size = None
+        self.closed = False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        self.requested_chunk_size = chunk_size
+        yield from self.chunks
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.closed = True
+
+
+class FakeSession:
+    def __init__(self, response):
+        self.response = response
+        self.calls = []
+
+    def get(self, url, **kwargs):
+        self.calls.append((url, kwargs))
+        return self.response
+
+
+def make_downloader(response, max_bytes=1024):
+    return types.SimpleNamespace(
+        LINE_CONTENT_API_BASE=ChatBot.LINE_CONTENT_API_BASE,
+        http_session=FakeSession(response),
+        line_access_token="token",
+        media_max_bytes=max_bytes,
+        media_download_chunk_bytes=4,
+        media_download_timeout=5.0,
+        metrics=Metrics(),
+    )
+
+
+def test_streams_chunks_to_disk_and_hashes(tmp_path):
+    chunks = [b"abcd", b"efgh", b"ij"]
+    response = FakeStreamingResponse(chunks, content_length=10)
+    downloader = make_downloader(response)
+    dest_path = tmp_path / "clip.m4a"
+
+    content_hash, size_bytes = ChatBot.download_message_content(downloader, "12345", dest_path)
+
+    assert dest_path.read_bytes() == b"abcdefghij"
+    assert content_hash == hashlib.sha256(b"abcdefghij").hexdigest()
+    assert size_bytes == 10
+    assert response.requested_chunk_size == 4
+    assert response.closed
+    url, kwargs = downloader.http_session.calls[0]
+    assert url == "https://api-data.line.me/v2/bot/message/12345/content"
+    assert kwargs["stream"] is True
+    assert kwargs["headers"]["Authorization"] == "Bearer token"
+    assert os.listdir(tmp_path) == ["clip.m4a"]
+
+
+def test_rejects_oversized_content_length_before_reading(tmp_path):
+    response = FakeStreamingResponse([b"never read"], content_length=2048)
+    dest_path = tmp_path / "clip.mp4"
+
+    with pytest.raises(MediaTooLargeError):
+        ChatBot.download_message_content(make_downloader(response), "1", dest_path)
+
+    assert response.requested_chunk_size is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_aborts_and_removes_partial_file_when_stream_exceeds_limit(tmp_path):
+    response = FakeStreamingResponse([b"x" * 6, b"x" * 6], content_length=None)
+    dest_path = tmp_path / "clip.mp4"
+
+    with pytest.raises(MediaTooLargeError):
+        ChatBot.download_message_content(make_downloader(response, max_bytes=8), "1", dest_path)
+
+    assert os.listdir(tmp_path) == []
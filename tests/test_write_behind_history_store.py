@@ -0,0 +1,132 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app import JsonHistoryStore, Metrics, WriteBehindHistoryStore
+
+
+def pending(turns=(), cleared=False, keep_last=None, updates=None):
+    return {"cleared": cleared, "turns": list(turns), "keep_last": keep_last, "updates": updates or {}}
+
+
+def user_turn(message_id, text="hi"):
+    return {"role": "user", "parts": [text], "message_id": message_id}
+
+
+class FlakyJsonHistoryStore(JsonHistoryStore):
+    def __init__(self, history_dir):
+        super().__init__(history_dir)
+        self.failures_left = 0
+
+    def write_batch(self, batch):
+        if self.failures_left:
+            self.failures_left -= 1
+            raise RuntimeError("backend unavailable")
+        return super().write_batch(batch)
+
+
+@pytest.fixture
+def backend(tmp_path):
+    return FlakyJsonHistoryStore(tmp_path)
+
+
+@pytest.fixture
+def store(backend):
+    metrics = Metrics()
+    write_behind = WriteBehindHistoryStore(backend, flush_interval=3600, metrics=metrics)
+    yield write_behind
+    write_behind.close()
+
+
+def test_merge_appends_turns_and_carries_keep_last_forward():
+    merged = WriteBehindHistoryStore._merge(
+        pending([user_turn("a"), user_turn("b")], keep_last=3),
+        pending([user_turn("c")]),
+    )
+
+    assert [turn["message_id"] for turn in merged["turns"]] == ["a", "b", "c"]
+    assert merged["keep_last"] == 4
+    assert merged["cleared"] is False
+
+
+def test_merge_trims_to_newer_keep_last():
+    merged = WriteBehindHistoryStore._merge(
+        pending([user_turn("a"), user_turn("b")], cleared=True),
+        pending([user_turn("c")], keep_last=2),
+    )
+
+    assert [turn["message_id"] for turn in merged["turns"]] == ["b", "c"]
+    assert merged["cleared"] is True
+
+
+def test_merge_lets_a_newer_clear_win():
+    newer = pending([user_turn("c")], cleared=True)
+
+    assert WriteBehindHistoryStore._merge(pending([user_turn("a")], updates={"x": {"k": 1}}), newer) is newer
+
+
+def test_merge_applies_updates_to_pending_turns_and_keeps_the_rest():
+    older = pending([user_turn("a")], updates={"stored": {"k": 1}})
+    merged = WriteBehindHistoryStore._merge(
+        older,
+        pending(updates={"a": {"descriptions": {"p": "A"}}, "stored": {"j": 2}}),
+    )
+
+    assert merged["turns"][0]["descriptions"] == {"p": "A"}
+    assert "descriptions" not in older["turns"][0]
+    assert merged["updates"] == {"stored": {"k": 1, "j": 2}}
+
+
+def test_load_combines_backend_with_pending_turns_and_updates(backend, store):
+    backend.append("u1", [user_turn("old"), {"role": "model", "parts": ["reply"]}])
+
+    store.append("u1", [user_turn("new")], keep_last=2)
+    store.update_turn("u1", "old", {"descriptions": {"p": "A"}})
+    store.update_turn("u1", "new", {"descriptions": {"q": "B"}})
+
+    history = store.load("u1")
+    assert [turn.get("message_id") for turn in history] == [None, "new"]
+    assert history[1]["descriptions"] == {"q": "B"}
+    assert backend.load("u1")[0].get("descriptions") is None
+
+    store.flush()
+    assert backend.load("u1") == history
+
+
+def test_load_reflects_pending_clear(backend, store):
+    backend.append("u1", [user_turn("old")])
+
+    store.clear("u1")
+    store.append("u1", [user_turn("new")])
+
+    assert [turn["message_id"] for turn in store.load("u1")] == ["new"]
+
+
+def test_queued_turns_are_snapshots(store):
+    turn = user_turn("a")
+    store.append("u1", [turn])
+
+    turn.setdefault("descriptions", {})["p"] = "late edit"
+    store.load("u1")[0]["parts"].append("caller edit")
+
+    assert store._pending["u1"]["turns"] == [user_turn("a")]
+
+
+def test_failed_flush_requeues_batch_ahead_of_newer_entries(backend, store):
+    backend.failures_left = 1
+    store.append("u1", [user_turn("a")])
+    store.append("u2", [user_turn("b")])
+
+    store.flush()
+    assert set(store._pending) == {"u1", "u2"}
+    assert store.metrics.snapshot()["counters"]["history_writer.failed_users"] == 2
+
+    store.append("u1", [user_turn("c")])
+    store.flush()
+
+    assert store._pending == {}
+    assert [turn["message_id"] for turn in backend.load("u1")] == ["a", "c"]
+    assert [turn["message_id"] for turn in backend.load("u2")] == ["b"]